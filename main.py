@@ -1,20 +1,34 @@
 import asyncio
+import json
 import logging
+import multiprocessing
 import os
+import queue
 import re
 import sqlite3
 import sys
+import threading
 import hashlib
+import secrets
+import signal
+import tempfile
 import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher.handler import CancelHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
 from aiogram.utils import executor
-from telethon import TelegramClient, errors
+from aiogram.utils.exceptions import RetryAfter, BotBlocked, ChatNotFound, UserDeactivated, CantInitiateConversation, BadRequest, Unauthorized
+from telethon import TelegramClient, errors, utils
+from telethon.tl.functions import PingRequest
 from telethon.tl.functions.channels import LeaveChannelRequest
 from telethon.tl.functions.messages import CheckChatInviteRequest, ImportChatInviteRequest
+from telethon.tl.types import ChannelParticipantsAdmins, InputPeerChannel, InputPeerChat
 
 # ---------- CONFIG ----------
 load_dotenv()
@@ -32,13 +46,75 @@ for part in re.split(r'[,;\s]+', ADMIN_IDS_RAW.strip()):
             pass
 USERBOT_SESSION = os.getenv('USERBOT_SESSION') or 'userbot.session'
 DB_PATH = os.getenv('DB_PATH') or 'bot_database.db'
+# ARCHIVE_DB_PATH: cold store for settled sold_groups/withdrawals older than ARCHIVE_AFTER_DAYS (0 = never archive)
+ARCHIVE_DB_PATH = os.getenv('ARCHIVE_DB_PATH') or os.path.splitext(DB_PATH)[0] + '_archive.db'
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS') or 180)
 MAINTENANCE = os.getenv('MAINTENANCE') == '1'
+# CAPTURE_UPDATES: path of a JSONL file to append redacted incoming updates to
+CAPTURE_UPDATES = os.getenv('CAPTURE_UPDATES') or ''
+CAPTURE_SALT = os.getenv('CAPTURE_SALT') or secrets.token_hex(16)
+# spawned shard workers inherit it, so one capture hashes ids the same way in every process
+os.environ['CAPTURE_SALT'] = CAPTURE_SALT
+if any(flag in sys.argv for flag in ('--replay', '--stress-transfers', '--bench-shards')):
+    # replays, stress runs and benchmarks use a scratch database and never reach the real
+    # userbot; spawned bench workers see the same argv and reuse the parent's scratch path
+    DB_PATH = os.getenv('SCRATCH_DB_PATH') or os.path.join(tempfile.mkdtemp(prefix='scratch_'), 'scratch.db')
+    os.environ['SCRATCH_DB_PATH'] = DB_PATH
+    ARCHIVE_DB_PATH = os.path.splitext(DB_PATH)[0] + '_archive.db'
+    API_ID = 0
+    CAPTURE_UPDATES = ''
+# SHARD_WORKERS: number of worker processes behind one polling ingress (0 = single process)
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS') or 0)
+# BOT_API_SERVER: base URL of a self-hosted telegram-bot-api server, e.g. http://127.0.0.1:8081
+BOT_API_SERVER = os.getenv('BOT_API_SERVER') or ''
+BOT_API_POOL_SIZE = int(os.getenv('BOT_API_POOL_SIZE') or 100)
+BOT_API_KEEPALIVE = float(os.getenv('BOT_API_KEEPALIVE') or 60)
+BOT_API_TIMEOUT = float(os.getenv('BOT_API_TIMEOUT') or 30)
+# per-method request timeouts (seconds); getUpdates keeps the polling timeout.
+# BOT_API_METHOD_TIMEOUTS overrides or adds entries, e.g. sendMessage=10,getChatMember=5
+BOT_API_METHOD_TIMEOUTS = {
+    'sendMessage': 10,
+    'editMessageText': 10,
+    'answerCallbackQuery': 5,
+    'getChatMember': 5,
+    'sendChatAction': 5,
+}
+for part in (os.getenv('BOT_API_METHOD_TIMEOUTS') or '').split(','):
+    method, _, seconds = part.partition('=')
+    try:
+        BOT_API_METHOD_TIMEOUTS[method.strip()] = float(seconds)
+    except ValueError:
+        pass
 
 if not BOT_TOKEN or not ADMIN_IDS:
     raise SystemExit('Please set BOT_TOKEN and ADMIN_IDS (or ADMIN_ID) in .env')
 
 logging.basicConfig(level=logging.INFO)
-bot = Bot(token=BOT_TOKEN)
+
+# ---------- BOT API TRANSPORT ----------
+class PooledBot(Bot):
+    """Bot with a sized keep-alive connection pool and per-method timeouts."""
+
+    def __init__(self, *args, keepalive_timeout=BOT_API_KEEPALIVE, **kwargs):
+        super().__init__(*args, **kwargs)
+        # aiogram builds its TCPConnector from _connector_init (limit=connections_limit)
+        if keepalive_timeout:
+            self._connector_init.update(keepalive_timeout=keepalive_timeout)
+        else:
+            self._connector_init.update(force_close=True)
+        self._connector_init.update(ttl_dns_cache=300)
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        timeout = BOT_API_METHOD_TIMEOUTS.get(method)
+        if timeout is None:
+            return await super().request(method, data, files, **kwargs)
+        with self.request_timeout(timeout):
+            return await super().request(method, data, files, **kwargs)
+
+def bot_api_server():
+    return TelegramAPIServer.from_base(BOT_API_SERVER.rstrip('/')) if BOT_API_SERVER else TELEGRAM_PRODUCTION
+
+bot = PooledBot(token=BOT_TOKEN, server=bot_api_server(), connections_limit=BOT_API_POOL_SIZE, timeout=BOT_API_TIMEOUT)
 storage = MemoryStorage()
 dp = Dispatcher(bot, storage=storage)
 
@@ -46,8 +122,13 @@ dp = Dispatcher(bot, storage=storage)
 telethon_client = None
 
 # ---------- DATABASE SETUP ----------
-conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+conn = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=30)
 cur = conn.cursor()
+# takes effect only on a new, empty DB; existing ones switch via --enable-incremental-vacuum
+cur.execute('PRAGMA auto_vacuum=INCREMENTAL')
+# WAL lets shard workers read concurrently; writers queue on SQLite's lock (busy_timeout)
+cur.execute('PRAGMA journal_mode=WAL')
+cur.execute('PRAGMA busy_timeout=30000')
 
 cur.execute('''
 CREATE TABLE IF NOT EXISTS users (
@@ -101,6 +182,164 @@ CREATE TABLE IF NOT EXISTS settings (
     value TEXT
 )
 ''')
+
+def add_column_if_missing(table, column, decl):
+    cur.execute(f'PRAGMA table_info({table})')
+    if column not in [r[1] for r in cur.fetchall()]:
+        cur.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
+        return True
+    return False
+
+add_column_if_missing('supports', 'claimed_by', 'INTEGER')
+add_column_if_missing('supports', 'claimed_at', 'TEXT')
+if add_column_if_missing('supports', 'notified_at', 'TEXT'):
+    # tickets from before the digest were already pushed to admins one by one
+    cur.execute('UPDATE supports SET notified_at=asked_at')
+cur.execute('CREATE INDEX IF NOT EXISTS idx_supports_status_asked ON supports(status, asked_at)')
+
+cur.execute('''
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER,
+    text TEXT,
+    reply_markup TEXT,
+    status TEXT DEFAULT 'pending',
+    attempts INTEGER DEFAULT 0,
+    next_attempt_at REAL,
+    last_error TEXT,
+    created_at TEXT,
+    sent_at TEXT
+)
+''')
+cur.execute('CREATE INDEX IF NOT EXISTS idx_outbox_status_next ON outbox(status, next_attempt_at)')
+cur.execute('DROP INDEX IF EXISTS idx_outbox_chat_status')
+cur.execute('CREATE INDEX IF NOT EXISTS idx_outbox_status_chat ON outbox(status, chat_id)')
+
+add_column_if_missing('sold_groups', 'price_tier', 'TEXT')
+add_column_if_missing('sold_groups', 'group_peer_id', 'INTEGER')
+add_column_if_missing('users', 'username', 'TEXT')
+add_column_if_missing('users', 'full_name', 'TEXT')
+
+# FTS5 indexes for admin search, kept in sync with their base tables by triggers
+def create_fts_index(db, table, rowid, columns):
+    fts = f'{table}_fts'
+    cols = ', '.join(columns)
+    new_cols = ', '.join(f'new.{c}' for c in columns)
+    old_cols = ', '.join(f'old.{c}' for c in columns)
+    exists = db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (fts,)).fetchone()
+    db.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({cols}, content='{table}', content_rowid='{rowid}', "
+               f"tokenize='unicode61 remove_diacritics 2', prefix='2 3')")
+    db.execute(f'CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN '
+               f'INSERT INTO {fts}(rowid, {cols}) VALUES (new.{rowid}, {new_cols}); END')
+    db.execute(f'CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN '
+               f"INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.{rowid}, {old_cols}); END")
+    db.execute(f'CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {cols} ON {table} BEGIN '
+               f"INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.{rowid}, {old_cols}); "
+               f'INSERT INTO {fts}(rowid, {cols}) VALUES (new.{rowid}, {new_cols}); END')
+    if not exists:
+        db.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+create_fts_index(cur, 'users', 'user_id', ('username', 'full_name'))
+create_fts_index(cur, 'supports', 'id', ('question', 'admin_reply'))
+create_fts_index(cur, 'sold_groups', 'id', ('group_title', 'group_link'))
+SOLD_GROUPS_INDEXES = ('idx_sold_groups_user ON sold_groups(user_id, sold_at)',
+                       'idx_sold_groups_peer ON sold_groups(group_peer_id)',
+                       'idx_sold_groups_link ON sold_groups(group_link)')
+for index in SOLD_GROUPS_INDEXES:
+    cur.execute(f'CREATE INDEX IF NOT EXISTS {index}')
+cur.execute('CREATE INDEX IF NOT EXISTS idx_withdrawals_user ON withdrawals(user_id, requested_at)')
+
+# Cold archive: settled rows move to the same tables in ARCHIVE_DB_PATH (archive_settled_rows),
+# attached here as 'archive'. Full-history reads use the <table>_all temp views; writes go to main.
+ARCHIVED_TABLES = {
+    'sold_groups': ('sold_at < ?', SOLD_GROUPS_INDEXES),
+    'withdrawals': ("status IN ('approved', 'declined') AND requested_at < ?", ('idx_withdrawals_user ON withdrawals(user_id, requested_at)',)),
+}
+adb = sqlite3.connect(ARCHIVE_DB_PATH, timeout=30)
+adb.execute('PRAGMA auto_vacuum=INCREMENTAL')
+adb.execute('PRAGMA journal_mode=WAL')
+for table, (_, indexes) in ARCHIVED_TABLES.items():
+    # mirror main's columns, including ones added by later migrations
+    adb.execute(f'CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY)')
+    have = {r[1] for r in adb.execute(f'PRAGMA table_info({table})')}
+    for _, name, decl, *_ in cur.execute(f'PRAGMA table_info({table})').fetchall():
+        if name not in have:
+            adb.execute(f'ALTER TABLE {table} ADD COLUMN {name} {decl}')
+    for index in indexes:
+        adb.execute(f'CREATE INDEX IF NOT EXISTS {index}')
+create_fts_index(adb, 'sold_groups', 'id', ('group_title', 'group_link'))
+adb.commit()
+adb.close()
+cur.execute('ATTACH DATABASE ? AS archive', (ARCHIVE_DB_PATH,))
+for table in ARCHIVED_TABLES:
+    cols = ', '.join(r[1] for r in cur.execute(f'PRAGMA main.table_info({table})').fetchall())
+    cur.execute(f'CREATE TEMP VIEW {table}_all AS SELECT {cols} FROM main.{table} UNION ALL SELECT {cols} FROM archive.{table}')
+
+# daily rollups, maintained in the same transaction as the sale / withdrawal change
+cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='daily_sales'")
+ROLLUPS_CREATED = cur.fetchone() is None
+cur.execute('''
+CREATE TABLE IF NOT EXISTS daily_sales (
+    day TEXT,
+    tier TEXT,
+    groups INTEGER DEFAULT 0,
+    usd REAL DEFAULT 0,
+    inr REAL DEFAULT 0,
+    PRIMARY KEY (day, tier)
+)
+''')
+
+cur.execute('''
+CREATE TABLE IF NOT EXISTS daily_withdrawals (
+    day TEXT,
+    method TEXT,
+    status TEXT,
+    count INTEGER DEFAULT 0,
+    amount REAL DEFAULT 0,
+    PRIMARY KEY (day, method, status)
+)
+''')
+
+cur.execute('''
+CREATE TABLE IF NOT EXISTS transfers (
+    transfer_key TEXT PRIMARY KEY,
+    user_id INTEGER,
+    status TEXT DEFAULT 'pending',
+    created_at TEXT,
+    expires_at TEXT
+)
+''')
+
+cur.execute('''
+CREATE TABLE IF NOT EXISTS transfer_items (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    transfer_key TEXT,
+    link TEXT,
+    title TEXT,
+    year_label TEXT,
+    messages_count INTEGER,
+    tier TEXT,
+    price_inr REAL,
+    price_usd REAL,
+    sold INTEGER DEFAULT 0
+)
+''')
+cur.execute('CREATE INDEX IF NOT EXISTS idx_transfer_items_key ON transfer_items(transfer_key)')
+add_column_if_missing('transfers', 'updated_at', 'TEXT')
+add_column_if_missing('transfer_items', 'peer_id', 'INTEGER')
+cur.execute('CREATE INDEX IF NOT EXISTS idx_transfer_items_peer ON transfer_items(peer_id)')
+# pending transfers used to live in settings as pending_transfer:<key>
+cur.execute("DELETE FROM settings WHERE key LIKE 'pending_transfer:%'")
+
+cur.execute('''
+CREATE TABLE IF NOT EXISTS peer_cache (
+    link TEXT PRIMARY KEY,
+    peer_type TEXT,
+    peer_id INTEGER,
+    access_hash INTEGER,
+    resolved_at TEXT
+)
+''')
 conn.commit()
 
 # default settings if not present
@@ -113,6 +352,11 @@ def set_setting(key, value):
     cur.execute('REPLACE INTO settings(key,value) VALUES(?,?)', (key, str(value)))
     conn.commit()
 
+def maintenance_on() -> bool:
+    # read from the DB so a toggle reaches every shard worker; MAINTENANCE is only the default
+    v = get_setting('maintenance')
+    return MAINTENANCE if not v else v == '1'
+
 if get_setting('welcome_message') is None:
     set_setting('welcome_message', 'Welcome! Use the menu below to start.')
 if get_setting('mandatory_channel') is None:
@@ -124,11 +368,71 @@ if get_setting('price_list') is None:
 def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
+# Known-user cache: bounded LRU of user ids already present in `users`, warmed as users
+# interact. First-time users are queued and inserted in batches (INSERT OR IGNORE);
+# call flush_new_users() before any statement that needs the row to exist.
+# Display names ride along: known_users maps id -> last stored (username, full_name).
+KNOWN_USERS_MAX = int(os.getenv('KNOWN_USERS_MAX') or 100000)
+NEW_USERS_BATCH = 100
+NEW_USERS_FLUSH_SECONDS = 5
+known_users = OrderedDict()
+new_users = {}
+profile_updates = {}
+
+def remember_user(user_id: int):
+    known_users.setdefault(user_id, None)
+    known_users.move_to_end(user_id)
+    while len(known_users) > KNOWN_USERS_MAX:
+        known_users.popitem(last=False)
+
 def ensure_user(user_id: int):
-    cur.execute('SELECT user_id FROM users WHERE user_id=?', (user_id,))
-    if not cur.fetchone():
-        cur.execute('INSERT INTO users(user_id, joined_at) VALUES(?, ?)', (user_id, datetime.utcnow().isoformat()))
-        conn.commit()
+    if user_id in known_users:
+        known_users.move_to_end(user_id)
+        return
+    if user_id not in new_users:
+        cur.execute('SELECT user_id FROM users WHERE user_id=?', (user_id,))
+        if not cur.fetchone():
+            new_users[user_id] = datetime.utcnow().isoformat()
+            if len(new_users) >= NEW_USERS_BATCH:
+                flush_new_users()
+    remember_user(user_id)
+
+def note_user(user: types.User):
+    ensure_user(user.id)
+    profile = (user.username, user.full_name)
+    if known_users.get(user.id) != profile:
+        known_users[user.id] = profile
+        profile_updates[user.id] = profile
+
+def flush_new_users():
+    if not new_users and not profile_updates:
+        return
+    cur.executemany('INSERT OR IGNORE INTO users(user_id, joined_at) VALUES(?, ?)', list(new_users.items()))
+    cur.executemany('UPDATE users SET username=?, full_name=? WHERE user_id=?',
+                    [(username, full_name, uid) for uid, (username, full_name) in profile_updates.items()])
+    conn.commit()
+    new_users.clear()
+    profile_updates.clear()
+
+class UserProfileMiddleware(BaseMiddleware):
+    """Records who is talking to the bot (id, @username, display name)."""
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        if message.from_user:
+            note_user(message.from_user)
+
+    async def on_pre_process_callback_query(self, query: types.CallbackQuery, data: dict):
+        note_user(query.from_user)
+
+dp.middleware.setup(UserProfileMiddleware())
+
+async def new_users_flusher():
+    while True:
+        await asyncio.sleep(NEW_USERS_FLUSH_SECONDS)
+        try:
+            flush_new_users()
+        except Exception:
+            logging.exception('Failed to flush new users')
 
 def format_currency_usd(x):
     return f'${x:.2f}'
@@ -147,27 +451,332 @@ def parse_price_list(text):
             items.append((label, inr, usd))
     return items
 
+# ---------- NOTIFICATION OUTBOX ----------
+# Transactional messages are written to `outbox` in the same transaction as the change
+# they announce, then delivered by outbox_dispatcher. Rows are routed to a worker by
+# chat id, so messages to one chat keep their order and share one per-chat limit. A row
+# whose chat isn't due yet is handed back (picked up again on a later pass) rather than
+# holding up the other chats in its worker; a 429 pauses every chat, as it applies bot-wide.
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS') or 4)
+OUTBOX_GLOBAL_RATE = float(os.getenv('OUTBOX_GLOBAL_RATE') or 25)  # messages/sec across all chats
+OUTBOX_CHAT_INTERVAL = 1.0  # seconds between messages to the same chat
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_LAG_WARN_SECONDS = 60
+OUTBOX_KEEP_SENT_DAYS = 7
+OUTBOX_PERMANENT_ERRORS = (BotBlocked, ChatNotFound, UserDeactivated, CantInitiateConversation)
+outbox_wakeup = asyncio.Event()
+outbox_inflight = set()
+outbox_chat_next = {}
+outbox_chat_held = {}  # chat_id -> id of an earlier row waiting out a retry
+outbox_global_next = 0.0
+outbox_metrics = {'lag_seconds': 0.0, 'pending': 0, 'dead': 0}
+
+def enqueue_message(chat_id: int, text: str, reply_markup=None):
+    # no commit here: the caller commits together with its own change
+    cur.execute('INSERT INTO outbox(chat_id,text,reply_markup,next_attempt_at,created_at) VALUES(?,?,?,?,?)',
+                (chat_id, text, reply_markup.as_json() if reply_markup else None, time.time(), datetime.utcnow().isoformat()))
+    outbox_wakeup.set()
+
+async def outbox_global_slot():
+    global outbox_global_next
+    now = time.monotonic()
+    slot = max(now, outbox_global_next)
+    outbox_global_next = slot + 1.0 / OUTBOX_GLOBAL_RATE
+    if slot > now:
+        await asyncio.sleep(slot - now)
+
+def outbox_chat_due(chat_id: int) -> bool:
+    return outbox_chat_next.get(chat_id, 0.0) <= time.monotonic()
+
+async def deliver_outbox_row(row):
+    global outbox_global_next
+    oid, chat_id, text, reply_markup, attempts = row
+    held = outbox_chat_held.get(chat_id)
+    if not outbox_chat_due(chat_id) or (held is not None and held < oid):
+        return
+    await outbox_global_slot()
+    outbox_chat_next[chat_id] = time.monotonic() + OUTBOX_CHAT_INTERVAL
+    try:
+        await bot.send_message(chat_id, text, reply_markup=reply_markup)
+    except RetryAfter as e:
+        outbox_chat_next[chat_id] = time.monotonic() + e.timeout
+        outbox_global_next = max(outbox_global_next, time.monotonic() + e.timeout)
+        outbox_chat_held[chat_id] = oid
+        cur.execute('UPDATE outbox SET next_attempt_at=?, last_error=? WHERE id=?', (time.time() + e.timeout, str(e), oid))
+    except OUTBOX_PERMANENT_ERRORS as e:
+        outbox_chat_held.pop(chat_id, None)
+        cur.execute("UPDATE outbox SET status='dead', attempts=attempts+1, last_error=? WHERE id=?", (str(e), oid))
+    except Exception as e:
+        attempts += 1
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            outbox_chat_held.pop(chat_id, None)
+            cur.execute("UPDATE outbox SET status='dead', attempts=?, last_error=? WHERE id=?", (attempts, str(e), oid))
+        else:
+            outbox_chat_held[chat_id] = oid
+            cur.execute('UPDATE outbox SET attempts=?, next_attempt_at=?, last_error=? WHERE id=?',
+                        (attempts, time.time() + min(2 ** attempts, 600), str(e), oid))
+    else:
+        outbox_chat_held.pop(chat_id, None)
+        cur.execute("UPDATE outbox SET status='sent', sent_at=? WHERE id=?", (datetime.utcnow().isoformat(), oid))
+    conn.commit()
+
+async def outbox_worker(queue: asyncio.Queue):
+    while True:
+        row = await queue.get()
+        try:
+            await deliver_outbox_row(row)
+        except Exception:
+            logging.exception('Outbox delivery of #%s failed', row[0])
+        finally:
+            outbox_inflight.discard(row[0])
+
+def update_outbox_metrics():
+    cur.execute("SELECT COUNT(*), MIN(created_at) FROM outbox WHERE status='pending'")
+    pending, oldest = cur.fetchone()
+    cur.execute("SELECT COUNT(*) FROM outbox WHERE status='dead'")
+    dead = cur.fetchone()[0]
+    lag = (datetime.utcnow() - datetime.fromisoformat(oldest)).total_seconds() if oldest else 0.0
+    outbox_metrics.update(lag_seconds=lag, pending=pending, dead=dead)
+    cutoff = (datetime.utcnow() - timedelta(days=OUTBOX_KEEP_SENT_DAYS)).isoformat()
+    cur.execute("DELETE FROM outbox WHERE status='sent' AND sent_at < ?", (cutoff,))
+    conn.commit()
+    log = logging.warning if lag > OUTBOX_LAG_WARN_SECONDS else logging.info
+    log('Outbox lag=%.1fs pending=%d dead=%d', lag, pending, dead)
+
+async def outbox_dispatcher():
+    queues = [asyncio.Queue() for _ in range(OUTBOX_WORKERS)]
+    workers = [asyncio.create_task(outbox_worker(q)) for q in queues]
+    next_metrics = 0.0
+    try:
+        while True:
+            # only the oldest pending row of each chat: later rows wait for it (keeping their
+            # order), and a backlog to one chat takes one slot of the window, not all of it
+            cur.execute("SELECT o.id,o.chat_id,o.text,o.reply_markup,o.attempts FROM outbox o "
+                        "JOIN (SELECT MIN(id) AS id FROM outbox WHERE status='pending' GROUP BY chat_id) h ON h.id = o.id "
+                        "WHERE o.next_attempt_at <= ? ORDER BY o.id LIMIT 200", (time.time(),))
+            for row in cur.fetchall():
+                if row[0] in outbox_inflight or not outbox_chat_due(row[1]):
+                    continue
+                outbox_inflight.add(row[0])
+                queues[row[1] % OUTBOX_WORKERS].put_nowait(row)
+            outbox_wakeup.clear()
+            if time.monotonic() >= next_metrics:
+                update_outbox_metrics()
+                next_metrics = time.monotonic() + 60
+            try:
+                await asyncio.wait_for(outbox_wakeup.wait(), timeout=1)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        for w in workers:
+            w.cancel()
+
 # ---------- TRANSFER KEY helpers ----------
 def make_transfer_key(user_id: int, link: str) -> str:
     h = hashlib.sha1(f"{user_id}:{link}:{time.time()}".encode()).hexdigest()[:20]
     return f"t{h}"
 
-def store_pending_transfer(key: str, link: str, price_inr: float, price_usd: float, title: str, expires_minutes=15):
-    exp = (datetime.utcnow() + timedelta(minutes=expires_minutes)).isoformat()
-    set_setting(f'pending_transfer:{key}', f'{link}|{price_inr}|{price_usd}|{title}|{exp}')
-
-def load_pending_transfer(key: str):
-    v = get_setting(f'pending_transfer:{key}')
-    if not v:
-        return None
+# A transfer moves pending -> verifying -> pending/sold, or pending -> cancelled/expired.
+# Every move is a compare-and-swap on status, so only one tap (or shard process) wins.
+# A 'verifying' row older than TRANSFER_VERIFY_STALE seconds is left over from a crash
+# and may be taken over.
+TRANSFER_VERIFY_STALE = 120
+
+def group_claim_reason(item, now: str):
+    if item.get('peer_id') is not None:
+        cur.execute("SELECT 1 FROM transfer_items i JOIN transfers t ON t.transfer_key = i.transfer_key WHERE i.peer_id=? AND i.sold=0 "
+                    "AND (t.status='verifying' OR (t.status='pending' AND t.expires_at > ?)) LIMIT 1", (item['peer_id'], now))
+        if cur.fetchone():
+            return 'This group is already in a pending sale.'
+    cur.execute('SELECT 1 FROM sold_groups_all WHERE group_peer_id=? OR group_link=? LIMIT 1', (item.get('peer_id'), item['link']))
+    if cur.fetchone():
+        return 'This group has already been sold.'
+    return None
+
+def store_pending_transfer(key: str, user_id: int, items: list, expires_minutes=15):
+    """Stores the items nobody else holds or has sold; returns [(item, reason)] for the rest."""
+    now = datetime.utcnow()
+    # the claim check and the insert share one write lock, so two sellers (or shard
+    # processes) can't both put the same group into a pending transfer
+    conn.commit()
+    cur.execute('BEGIN IMMEDIATE')
     try:
-        link, inr_s, usd_s, title, exp = v.split('|', 4)
-        return dict(link=link, price_inr=float(inr_s), price_usd=float(usd_s), title=title, exp=exp)
+        rejected = [(it, reason) for it in items for reason in [group_claim_reason(it, now.isoformat())] if reason]
+        accepted = [it for it in items if not any(it is r for r, _ in rejected)]
+        if accepted:
+            cur.execute('INSERT INTO transfers(transfer_key,user_id,status,created_at,expires_at,updated_at) VALUES(?,?,?,?,?,?)',
+                        (key, user_id, 'pending', now.isoformat(), (now + timedelta(minutes=expires_minutes)).isoformat(), now.isoformat()))
+            cur.executemany('INSERT INTO transfer_items(transfer_key,link,title,year_label,messages_count,tier,price_inr,price_usd,peer_id) VALUES(?,?,?,?,?,?,?,?,?)',
+                            [(key, it['link'], it['title'], it['year_label'], it['messages_count'], it['tier'], it['price_inr'], it['price_usd'], it.get('peer_id'))
+                             for it in accepted])
+        conn.commit()
     except Exception:
+        conn.rollback()
+        raise
+    return rejected
+
+def load_pending_transfer(key: str, status='pending'):
+    cur.execute('SELECT user_id, expires_at, updated_at FROM transfers WHERE transfer_key=? AND status=?', (key, status))
+    row = cur.fetchone()
+    if not row:
         return None
+    cur.execute('SELECT id,link,title,year_label,messages_count,tier,price_inr,price_usd,sold,peer_id FROM transfer_items WHERE transfer_key=? ORDER BY id', (key,))
+    items = [dict(id=r[0], link=r[1], title=r[2], year_label=r[3], messages_count=r[4], tier=r[5], price_inr=r[6], price_usd=r[7], sold=bool(r[8]), peer_id=r[9])
+             for r in cur.fetchall()]
+    return dict(user_id=row[0], exp=row[1], token=row[2], items=items)
+
+def transfer_status(key: str):
+    cur.execute('SELECT status FROM transfers WHERE transfer_key=?', (key,))
+    row = cur.fetchone()
+    return row[0] if row else None
 
-def clear_pending_transfer(key: str):
-    set_setting(f'pending_transfer:{key}', '')
+def transition_transfer(key: str, old: str, new: str, token=None, commit=True):
+    """Compare-and-swap the transfer status; returns the new updated_at token, or None if it lost."""
+    fresh = datetime.utcnow().isoformat()
+    if token is None:
+        cur.execute('UPDATE transfers SET status=?, updated_at=? WHERE transfer_key=? AND status=?', (new, fresh, key, old))
+    else:
+        cur.execute('UPDATE transfers SET status=?, updated_at=? WHERE transfer_key=? AND status=? AND updated_at=?', (new, fresh, key, old, token))
+    won = cur.rowcount == 1
+    if commit:
+        conn.commit()
+    return fresh if won else None
+
+def begin_verify(key: str):
+    now = datetime.utcnow()
+    token = now.isoformat()
+    cur.execute("UPDATE transfers SET status='verifying', updated_at=? WHERE transfer_key=? AND (status='pending' OR (status='verifying' AND updated_at<?))",
+                (token, key, (now - timedelta(seconds=TRANSFER_VERIFY_STALE)).isoformat()))
+    won = cur.rowcount == 1
+    conn.commit()
+    return token if won else None
+
+def clear_pending_transfer(key: str, status='cancelled'):
+    return transition_transfer(key, 'pending', status) is not None
+
+# Taps on the same transfer_key share one in-flight run; duplicates return at once.
+transfer_inflight = {}
+
+async def transfer_single_flight(key: str, action: str, coro_fn):
+    flight = (key, action)
+    task = transfer_inflight.get(flight)
+    if task is not None:
+        return False
+    task = asyncio.ensure_future(coro_fn())
+    transfer_inflight[flight] = task
+    task.add_done_callback(lambda t: transfer_inflight.pop(flight, None))
+    # shielded so a cancelled handler can't abandon a transfer halfway through crediting
+    await asyncio.shield(task)
+    return True
+
+# ---------- ROLLUPS ----------
+def rollup_sale(sold_at: str, tier: str, price_usd: float, price_inr: float):
+    cur.execute('INSERT INTO daily_sales(day,tier,groups,usd,inr) VALUES(?,?,1,?,?) '
+                'ON CONFLICT(day,tier) DO UPDATE SET groups=groups+1, usd=usd+excluded.usd, inr=inr+excluded.inr',
+                (sold_at[:10], tier, price_usd, price_inr))
+
+def rollup_withdrawal(requested_at: str, method: str, amount: float, old_status, new_status: str):
+    day = requested_at[:10]
+    if old_status:
+        cur.execute('UPDATE daily_withdrawals SET count=count-1, amount=amount-? WHERE day=? AND method=? AND status=?',
+                    (amount, day, method, old_status))
+    cur.execute('INSERT INTO daily_withdrawals(day,method,status,count,amount) VALUES(?,?,?,1,?) '
+                'ON CONFLICT(day,method,status) DO UPDATE SET count=count+1, amount=amount+excluded.amount',
+                (day, method, new_status, amount))
+
+def rebuild_rollups():
+    cur.execute('DELETE FROM daily_sales')
+    cur.execute("INSERT INTO daily_sales(day,tier,groups,usd,inr) SELECT substr(sold_at,1,10), COALESCE(price_tier,'unknown'), "
+                "COUNT(*), SUM(price_usd), SUM(price_inr) FROM sold_groups_all GROUP BY 1, 2")
+    cur.execute('DELETE FROM daily_withdrawals')
+    cur.execute('INSERT INTO daily_withdrawals(day,method,status,count,amount) SELECT substr(requested_at,1,10), method, status, '
+                'COUNT(*), SUM(amount) FROM withdrawals_all GROUP BY 1, 2, 3')
+    conn.commit()
+
+if ROLLUPS_CREATED:
+    rebuild_rollups()
+
+def stats_text():
+    today = datetime.utcnow().date()
+    text = '📊 Stats (UTC)\n'
+    for label, days in (('Today', 1), ('Last 7 days', 7), ('Last 30 days', 30)):
+        since = (today - timedelta(days=days - 1)).isoformat()
+        cur.execute('SELECT tier, SUM(groups), SUM(usd), SUM(inr) FROM daily_sales WHERE day >= ? GROUP BY tier ORDER BY tier', (since,))
+        rows = cur.fetchall()
+        total = sum(r[1] for r in rows)
+        text += f"\n{label}: {total} groups — {format_currency_inr(sum(r[3] for r in rows))}/{format_currency_usd(sum(r[2] for r in rows))}\n"
+        for r in rows:
+            text += f'  • {r[0]}: {r[1]}\n'
+    cur.execute('SELECT method, status, SUM(count), SUM(amount) FROM daily_withdrawals GROUP BY method, status ORDER BY method, status')
+    text += '\nWithdrawals (all time):\n'
+    for method, status, count, amount in cur.fetchall():
+        if count:
+            text += f'  • {method} {status}: {count} ({amount:.2f})\n'
+    return text
+
+# ---------- ADMIN SEARCH ----------
+FIND_PAGE_SIZE = 5
+
+def fts_query(text: str) -> str:
+    # every word as a quoted prefix term, so user input can't inject FTS syntax
+    return ' '.join(f'"{w}"*' for w in re.findall(r'\w+', text))
+
+def find_page(text: str, page: int):
+    q = fts_query(text)
+    if not q:
+        return 'Nothing to search for.', None
+    off = page * FIND_PAGE_SIZE
+    lim = FIND_PAGE_SIZE + 1
+    cur.execute('SELECT u.user_id, u.username, u.full_name FROM users_fts f JOIN users u ON u.user_id = f.rowid '
+                'WHERE users_fts MATCH ? ORDER BY rank LIMIT ? OFFSET ?', (q, lim, off))
+    users = cur.fetchall()
+    cur.execute('SELECT s.id, s.status, s.user_id, s.question FROM supports_fts f JOIN supports s ON s.id = f.rowid '
+                'WHERE supports_fts MATCH ? ORDER BY rank LIMIT ? OFFSET ?', (q, lim, off))
+    tickets = cur.fetchall()
+    cur.execute('SELECT * FROM (SELECT g.id, g.user_id, g.group_title, g.group_link, g.sold_at, f.rank AS r FROM sold_groups_fts f '
+                'JOIN sold_groups g ON g.id = f.rowid WHERE sold_groups_fts MATCH ? UNION ALL '
+                'SELECT g.id, g.user_id, g.group_title, g.group_link, g.sold_at, f.rank FROM archive.sold_groups_fts f '
+                'JOIN archive.sold_groups g ON g.id = f.rowid WHERE f.sold_groups_fts MATCH ?) ORDER BY r LIMIT ? OFFSET ?', (q, q, lim, off))
+    groups = cur.fetchall()
+    text_out = f'🔎 Results for "{text}" (page {page + 1})\n'
+    text_out += '\nUsers:\n' + (''.join(f"• {r[0]} @{r[1] or '-'} {r[2] or ''}\n" for r in users[:FIND_PAGE_SIZE]) or '—\n')
+    text_out += '\nTickets:\n' + (''.join(f'• #{r[0]} [{r[1]}] from {r[2]}: {r[3][:60]}\n' for r in tickets[:FIND_PAGE_SIZE]) or '—\n')
+    text_out += '\nSold groups:\n' + (''.join(f'• #{r[0]} {r[2]} ({r[3]}) by {r[1]} at {r[4][:10]}\n' for r in groups[:FIND_PAGE_SIZE]) or '—\n')
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton('⬅️ Prev', callback_data=f'admin_find:{page - 1}'))
+    if max(len(users), len(tickets), len(groups)) > FIND_PAGE_SIZE:
+        nav.append(InlineKeyboardButton('Next ➡️', callback_data=f'admin_find:{page + 1}'))
+    return text_out, InlineKeyboardMarkup().row(*nav) if nav else None
+
+def bench_search(rows=1000000, queries=200):
+    # FTS5 MATCH vs. LIKE scan over a scratch sold_groups table.
+    import random
+    words = [f'{a}{b}' for a in ('alpha', 'crypto', 'news', 'trade', 'india', 'chat', 'deal', 'club') for b in range(250)]
+    db = sqlite3.connect(os.path.join(tempfile.mkdtemp(prefix='search_bench_'), 'bench.db'))
+    db.execute('CREATE TABLE sold_groups (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, group_link TEXT, group_title TEXT, sold_at TEXT)')
+    started = time.perf_counter()
+    db.executemany('INSERT INTO sold_groups(user_id,group_link,group_title,sold_at) VALUES(?,?,?,?)',
+                   ((i % 50000, f'https://t.me/+{i:x}grp', ' '.join(random.choices(words, k=3)), '2024-01-01') for i in range(rows)))
+    create_fts_index(db, 'sold_groups', 'id', ('group_title', 'group_link'))
+    db.commit()
+    print(f'{rows} rows loaded and indexed in {time.perf_counter() - started:.1f}s')
+    probe_sets = (
+        ('common word', random.choices(words, k=queries)),
+        ('single group link', [f'{random.randrange(rows):x}grp' for _ in range(queries // 10)]),
+    )
+    for kind, probes in probe_sets:
+        for label, sql, arg in (
+            ('fts5', 'SELECT g.id FROM sold_groups_fts f JOIN sold_groups g ON g.id = f.rowid WHERE sold_groups_fts MATCH ? ORDER BY rank LIMIT 6', fts_query),
+            ('like', 'SELECT id FROM sold_groups WHERE group_title LIKE ? OR group_link LIKE ? LIMIT 6', lambda w: f'%{w}%'),
+        ):
+            lat = []
+            for w in probes:
+                t = time.perf_counter()
+                db.execute(sql, (arg(w),) * sql.count('?')).fetchall()
+                lat.append(time.perf_counter() - t)
+            lat.sort()
+            print(f'{kind} / {label}: p50={lat[len(lat) // 2] * 1000:.2f}ms p99={lat[int(len(lat) * 0.99)] * 1000:.2f}ms')
 
 # ---------- KEYBOARDS ----------
 def main_menu_kb():
@@ -191,12 +800,91 @@ def reply_admin_kb():
     kb.add(KeyboardButton('Admin Panel'))
     return kb
 
+# ---------- MEMBERSHIP GATE ----------
+# Verdicts are cached per (channel, user): members for MEMBERSHIP_TTL, non-members only
+# briefly. Concurrent checks for the same key share one getChatMember call. Only a
+# left/kicked status blocks: a channel the bot can't check, or a failed call, lets the
+# user through (logged) rather than locking everyone out of selling and withdrawing.
+MEMBERSHIP_TTL = int(os.getenv('MEMBERSHIP_TTL') or 600)
+MEMBERSHIP_NEGATIVE_TTL = 15
+MEMBERSHIP_CACHE_MAX = 100000
+membership_cache = {}
+membership_inflight = {}
+
+async def fetch_membership(channel: str, user_id: int) -> bool:
+    try:
+        member = await bot.get_chat_member(channel, user_id)
+    except (BadRequest, Unauthorized) as e:
+        # invite links, unknown chats, or a bot without access to the member list
+        logging.warning('Cannot check membership of %s in %s, letting them through: %s', user_id, channel, e)
+        ok = True
+        ttl = MEMBERSHIP_NEGATIVE_TTL
+    except Exception as e:
+        # network trouble, timeouts, flood control: pass this once, cache nothing
+        logging.warning('Membership check of %s in %s failed, letting them through: %s', user_id, channel, e)
+        return True
+    else:
+        ok = member.status not in ('left', 'kicked')
+        ttl = MEMBERSHIP_TTL if ok else MEMBERSHIP_NEGATIVE_TTL
+    if len(membership_cache) >= MEMBERSHIP_CACHE_MAX:
+        now = time.monotonic()
+        for key in [k for k, v in membership_cache.items() if v[1] <= now]:
+            del membership_cache[key]
+    membership_cache[(channel, user_id)] = (ok, time.monotonic() + ttl)
+    return ok
+
+async def is_channel_member(user_id: int, fresh=False) -> bool:
+    channel = get_setting('mandatory_channel')
+    if not channel:
+        return True
+    key = (channel, user_id)
+    hit = membership_cache.get(key)
+    if hit and not fresh and hit[1] > time.monotonic():
+        return hit[0]
+    task = membership_inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(fetch_membership(channel, user_id))
+        membership_inflight[key] = task
+        task.add_done_callback(lambda t: membership_inflight.pop(key, None))
+    return await asyncio.shield(task)
+
+def invalidate_membership_cache():
+    membership_cache.clear()
+
+def membership_required(handler):
+    """Mark a handler as only reachable by members of the mandatory channel."""
+    handler.membership_required = True
+    return handler
+
+def join_channel_text():
+    return f"🚨 Please join the required channel before continuing:\n\n➡️ {get_setting('mandatory_channel')}"
+
+class MembershipGateMiddleware(BaseMiddleware):
+    """Cancels @membership_required handlers for users outside the mandatory channel."""
+
+    async def blocked(self, user_id: int) -> bool:
+        if not getattr(current_handler.get(), 'membership_required', False) or is_admin(user_id):
+            return False
+        return not await is_channel_member(user_id)
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        if await self.blocked(message.from_user.id):
+            await message.answer(join_channel_text())
+            raise CancelHandler()
+
+    async def on_process_callback_query(self, query: types.CallbackQuery, data: dict):
+        if await self.blocked(query.from_user.id):
+            await query.answer(join_channel_text(), show_alert=True)
+            raise CancelHandler()
+
+dp.middleware.setup(MembershipGateMiddleware())
+
 # ---------- START / JOIN CHECK ----------
 @dp.message_handler(commands=['start'])
 async def cmd_start(message: types.Message):
     ensure_user(message.from_user.id)
 
-    if MAINTENANCE and not is_admin(message.from_user.id):
+    if maintenance_on() and not is_admin(message.from_user.id):
         await message.answer('⚠️ Bot is under maintenance. Please try later.')
         return
 
@@ -210,20 +898,8 @@ async def cmd_start(message: types.Message):
 
 @dp.callback_query_handler(lambda c: c.data == 'continue_after_join')
 async def cb_continue_after_join(query: types.CallbackQuery):
-    mandatory = get_setting('mandatory_channel')
-
-    # check membership (username style). If mandatory is an invite link, we can't reliably check server-side.
-    try:
-        if mandatory.startswith('@'):
-            member = await bot.get_chat_member(mandatory, query.from_user.id)
-            if member.status in ('left', 'kicked'):
-                raise Exception('not a member')
-        else:
-            # attempt get_chat_member - may fail for invite links; if it fails require manual verification
-            member = await bot.get_chat_member(mandatory, query.from_user.id)
-            if member.status in ('left', 'kicked'):
-                raise Exception('not a member')
-    except Exception:
+    # a user who just joined taps Continue, so don't trust a cached "not a member"
+    if not await is_channel_member(query.from_user.id, fresh=True):
         await query.answer('❌ You must join the required channel first or the bot cannot verify your membership.', show_alert=True)
         return
 
@@ -247,7 +923,7 @@ async def msg_profile(message: types.Message):
     ensure_user(message.from_user.id)
     cur.execute('SELECT balance_usd, balance_inr FROM users WHERE user_id=?', (message.from_user.id,))
     r = cur.fetchone() or (0.0, 0.0)
-    cur.execute('SELECT COUNT(*) FROM sold_groups WHERE user_id=?', (message.from_user.id,))
+    cur.execute('SELECT COUNT(*) FROM sold_groups_all WHERE user_id=?', (message.from_user.id,))
     sold_count = cur.fetchone()[0]
 
     text = f"👤 Your Profile\n🆔 User ID: {message.from_user.id}\n💰 Balance: {format_currency_inr(r[1])}/{format_currency_usd(r[0])}\n👥 Groups sold: {sold_count}"
@@ -257,6 +933,7 @@ async def msg_profile(message: types.Message):
     await message.reply(text, reply_markup=kb)
 
 @dp.message_handler(lambda m: m.text == '💸 Withdraw')
+@membership_required
 async def msg_withdraw(message: types.Message):
     kb = InlineKeyboardMarkup()
     kb.add(InlineKeyboardButton('$ USDT BEP20', callback_data='withdraw_usdt'), InlineKeyboardButton('₹ INR', callback_data='withdraw_inr'))
@@ -279,7 +956,7 @@ async def cb_profile(query: types.CallbackQuery):
     ensure_user(query.from_user.id)
     cur.execute('SELECT balance_usd, balance_inr FROM users WHERE user_id=?', (query.from_user.id,))
     r = cur.fetchone() or (0.0, 0.0)
-    cur.execute('SELECT COUNT(*) FROM sold_groups WHERE user_id=?', (query.from_user.id,))
+    cur.execute('SELECT COUNT(*) FROM sold_groups_all WHERE user_id=?', (query.from_user.id,))
     sold_count = cur.fetchone()[0]
 
     text = f"👤 Your Profile\n🆔 User ID: {query.from_user.id}\n💰 Balance: {format_currency_inr(r[1])}/{format_currency_usd(r[0])}\n👥 Groups sold: {sold_count}"
@@ -290,7 +967,7 @@ async def cb_profile(query: types.CallbackQuery):
 
 @dp.callback_query_handler(lambda c: c.data == 'sold_history')
 async def cb_sold_history(query: types.CallbackQuery):
-    cur.execute('SELECT group_title,group_year,price_inr,price_usd,sold_at FROM sold_groups WHERE user_id=? ORDER BY sold_at DESC', (query.from_user.id,))
+    cur.execute('SELECT group_title,group_year,price_inr,price_usd,sold_at FROM sold_groups_all WHERE user_id=? ORDER BY sold_at DESC', (query.from_user.id,))
     rows = cur.fetchall()
     if not rows:
         await query.message.edit_text('📜 No sold groups yet.', reply_markup=back_kb)
@@ -311,17 +988,82 @@ async def handle_support_msg(message: types.Message):
     ensure_user(message.from_user.id)
     cur.execute('INSERT INTO supports(user_id, question, asked_at) VALUES(?,?,?)', (message.from_user.id, message.text, datetime.utcnow().isoformat()))
     conn.commit()
-    support_id = cur.lastrowid
+    # admins are told about new tickets by support_digest_loop
     await message.answer('✅ Your message has been sent to support. We\'ll reply here soon.')
-    # forward to ALL admins
-    kb = InlineKeyboardMarkup()
-    kb.add(InlineKeyboardButton('Reply', callback_data=f'admin_reply_support:{support_id}'))
+    await dp.current_state(user=message.from_user.id).reset_state()
+
+# ---------- SUPPORT INBOX ----------
+SUPPORT_PAGE_SIZE = 10
+SUPPORT_CLAIM_MINUTES = 30
+SUPPORT_DIGEST_SECONDS = int(os.getenv('SUPPORT_DIGEST_SECONDS') or 60)
+
+def support_inbox_page(page: int):
+    cur.execute("SELECT COUNT(*) FROM supports WHERE status='open'")
+    total = cur.fetchone()[0]
+    cur.execute("SELECT id,user_id,question,claimed_by,asked_at FROM supports WHERE status='open' ORDER BY asked_at LIMIT ? OFFSET ?",
+                (SUPPORT_PAGE_SIZE, page * SUPPORT_PAGE_SIZE))
+    rows = cur.fetchall()
+    pages = max(1, (total + SUPPORT_PAGE_SIZE - 1) // SUPPORT_PAGE_SIZE)
+    text = f'📥 Open tickets: {total} (page {page + 1}/{pages})\n\n'
+    kb = InlineKeyboardMarkup(row_width=2)
+    for r in rows:
+        claimed = f' [claimed by {r[3]}]' if r[3] else ''
+        text += f"#{r[0]} • {r[1]} • {r[4][:16]}{claimed}\n{r[2][:80]}\n\n"
+        kb.add(InlineKeyboardButton(f'Reply #{r[0]}', callback_data=f'admin_reply_support:{r[0]}'))
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton('⬅️ Prev', callback_data=f'admin_inbox:{page - 1}'))
+    if page + 1 < pages:
+        nav.append(InlineKeyboardButton('Next ➡️', callback_data=f'admin_inbox:{page + 1}'))
+    if nav:
+        kb.row(*nav)
+    if not rows:
+        text += 'No open tickets.'
+    return text, kb
+
+def claim_support(support_id: int, admin_id: int) -> bool:
+    now = datetime.utcnow()
+    stale = (now - timedelta(minutes=SUPPORT_CLAIM_MINUTES)).isoformat()
+    cur.execute("UPDATE supports SET claimed_by=?, claimed_at=? WHERE id=? AND status='open' AND (claimed_by IS NULL OR claimed_by=? OR claimed_at < ?)",
+                (admin_id, now.isoformat(), support_id, admin_id, stale))
+    conn.commit()
+    return cur.rowcount == 1
+
+def send_support_digest():
+    cur.execute("SELECT id,user_id,question FROM supports WHERE status='open' AND notified_at IS NULL ORDER BY id")
+    rows = cur.fetchall()
+    if not rows:
+        return
+    text = f'🆕 {len(rows)} new support ticket(s):\n\n'
+    for r in rows[:20]:
+        text += f"#{r[0]} from {r[1]}: {r[2][:80]}\n"
+    if len(rows) > 20:
+        text += f'…and {len(rows) - 20} more\n'
+    kb = InlineKeyboardMarkup().add(InlineKeyboardButton('📥 Open inbox', callback_data='admin_inbox:0'))
+    cur.executemany('UPDATE supports SET notified_at=? WHERE id=?', [(datetime.utcnow().isoformat(), r[0]) for r in rows])
     for aid in ADMIN_IDS:
+        enqueue_message(aid, text, reply_markup=kb)
+    conn.commit()
+
+async def support_digest_loop():
+    while True:
+        await asyncio.sleep(SUPPORT_DIGEST_SECONDS)
         try:
-            await bot.send_message(aid, f'🆕 Support #{support_id}\nFrom: {message.from_user.full_name} ({message.from_user.id})\nQuestion:\n{message.text}', reply_markup=kb)
+            send_support_digest()
         except Exception:
-            pass
-    await dp.current_state(user=message.from_user.id).reset_state()
+            logging.exception('Support digest failed')
+
+@dp.callback_query_handler(lambda c: c.data and c.data.startswith('admin_inbox:'))
+async def cb_admin_inbox(query: types.CallbackQuery):
+    if not is_admin(query.from_user.id):
+        await query.answer('Unauthorized', show_alert=True)
+        return
+    try:
+        page = max(0, int(query.data.split(':', 1)[1]))
+    except Exception:
+        page = 0
+    text, kb = support_inbox_page(page)
+    await query.message.answer(text, reply_markup=kb)
 
 @dp.callback_query_handler(lambda c: c.data and c.data.startswith('admin_reply_support:'))
 async def cb_admin_reply_support(query: types.CallbackQuery):
@@ -329,35 +1071,94 @@ async def cb_admin_reply_support(query: types.CallbackQuery):
         await query.answer('Unauthorized', show_alert=True)
         return
     _id = int(query.data.split(':', 1)[1])
+    if not claim_support(_id, query.from_user.id):
+        await query.answer('Ticket already answered or claimed by another admin.', show_alert=True)
+        return
     await query.message.answer('Type your reply for support id '+str(_id))
-    await dp.current_state(user=query.from_user.id).set_state(f'admin_reply_{_id}')
+    state = dp.current_state(user=query.from_user.id)
+    await state.set_state('admin_reply_support')
+    await state.update_data(support_id=_id)
+
+# ---------- ADMIN COMMANDS ----------
+# registered ahead of ignore_slash_commands so they work from any state
+@dp.message_handler(commands=['stats'], state='*')
+async def cmd_stats(message: types.Message):
+    if not is_admin(message.from_user.id):
+        await message.reply('Unauthorized.')
+        return
+    await message.reply(stats_text())
+
+@dp.message_handler(commands=['profile'], state='*')
+async def cmd_profile(message: types.Message):
+    global profile_running
+    if not is_admin(message.from_user.id):
+        await message.reply('Unauthorized.')
+        return
+    if profile_running:
+        await message.reply('A profile is already running.')
+        return
+    try:
+        seconds = min(float(message.get_args() or 30), PROFILE_MAX_SECONDS)
+    except ValueError:
+        await message.reply('Usage: /profile [seconds]')
+        return
+    # claimed here, not in the task, so a second /profile right behind this one is refused
+    profile_running = True
+    asyncio.create_task(profile_and_report(message.from_user.id, seconds))
+    await message.reply(f'🩺 Profiling for {seconds:.0f}s. The report will be sent here.')
+
+@dp.message_handler(commands=['find'], state='*')
+async def cmd_find(message: types.Message):
+    if not is_admin(message.from_user.id):
+        await message.reply('Unauthorized.')
+        return
+    text = (message.get_args() or '').strip()
+    if not text:
+        await message.reply('Usage: /find <name, @username, ticket text or group title/link>')
+        return
+    flush_new_users()
+    await dp.current_state(user=message.from_user.id).update_data(find_query=text)
+    out, kb = find_page(text, 0)
+    await message.reply(out, reply_markup=kb)
+
+@dp.callback_query_handler(lambda c: c.data and c.data.startswith('admin_find:'), state='*')
+async def cb_admin_find(query: types.CallbackQuery):
+    if not is_admin(query.from_user.id):
+        await query.answer('Unauthorized', show_alert=True)
+        return
+    text = (await dp.current_state(user=query.from_user.id).get_data()).get('find_query')
+    if not text:
+        await query.answer('Search expired. Run /find again.', show_alert=True)
+        return
+    out, kb = find_page(text, max(0, int(query.data.split(':', 1)[1])))
+    await query.message.edit_text(out, reply_markup=kb)
 
 @dp.message_handler(lambda message: message.text and message.text.startswith('/'), state='*')
 async def ignore_slash_commands(message: types.Message):
     pass
 
-@dp.message_handler(state=lambda state: state and state.startswith('admin_reply_'))
+@dp.message_handler(state='admin_reply_support')
 async def handle_admin_reply(message: types.Message):
-    st = (await dp.current_state(user=message.from_user.id).get_state())
-    if not st:
-        return
-    support_id = int(st.split('_')[-1])
+    state = dp.current_state(user=message.from_user.id)
     if not is_admin(message.from_user.id):
         await message.answer('Unauthorized')
-        await dp.current_state(user=message.from_user.id).reset_state()
+        await state.reset_state()
+        return
+    support_id = (await state.get_data()).get('support_id')
+    cur.execute("UPDATE supports SET admin_reply=?, status=? WHERE id=? AND status='open' AND claimed_by=?",
+                (message.text, 'answered', support_id, message.from_user.id))
+    if cur.rowcount != 1:
+        conn.commit()
+        await message.answer('Ticket was already answered or claimed by another admin.')
+        await state.reset_state()
         return
-    cur.execute('UPDATE supports SET admin_reply=?, status=? WHERE id=?', (message.text, 'answered', support_id))
-    conn.commit()
     cur.execute('SELECT user_id FROM supports WHERE id=?', (support_id,))
     row = cur.fetchone()
     if row:
-        uid = row[0]
-        try:
-            await bot.send_message(uid, f'💬 Support reply:\n{message.text}')
-        except Exception:
-            pass
+        enqueue_message(row[0], f'💬 Support reply:\n{message.text}')
+    conn.commit()
     await message.answer('Reply sent.')
-    await dp.current_state(user=message.from_user.id).reset_state()
+    await state.reset_state()
 
 @dp.callback_query_handler(lambda c: c.data == 'price')
 async def cb_price(query: types.CallbackQuery):
@@ -366,6 +1167,7 @@ async def cb_price(query: types.CallbackQuery):
 
 # ---------- WITHDRAWAL FLOWS ----------
 @dp.callback_query_handler(lambda c: c.data == 'withdraw')
+@membership_required
 async def cb_withdraw(query: types.CallbackQuery):
     kb = InlineKeyboardMarkup()
     kb.add(InlineKeyboardButton('$ USDT BEP20', callback_data='withdraw_usdt'), InlineKeyboardButton('₹ INR', callback_data='withdraw_inr'))
@@ -376,7 +1178,7 @@ async def cb_withdraw(query: types.CallbackQuery):
 @dp.callback_query_handler(lambda c: c.data == 'withdraw_history')
 async def cb_withdraw_history(query: types.CallbackQuery):
     ensure_user(query.from_user.id)
-    cur.execute('SELECT id,method,amount,target,status,requested_at FROM withdrawals WHERE user_id=? ORDER BY requested_at DESC', (query.from_user.id,))
+    cur.execute('SELECT id,method,amount,target,status,requested_at FROM withdrawals_all WHERE user_id=? ORDER BY requested_at DESC', (query.from_user.id,))
     rows = cur.fetchall()
     if not rows:
         await query.message.edit_text('📜 No withdrawals yet.', reply_markup=back_kb)
@@ -388,16 +1190,19 @@ async def cb_withdraw_history(query: types.CallbackQuery):
     await query.message.edit_text(text, reply_markup=kb)
 
 @dp.callback_query_handler(lambda c: c.data == 'withdraw_usdt')
+@membership_required
 async def cb_withdraw_usdt(query: types.CallbackQuery):
     await query.message.edit_text('💵 Enter withdrawal amount (USD):')
     await dp.current_state(user=query.from_user.id).set_state('awaiting_withdraw_usd')
 
 @dp.callback_query_handler(lambda c: c.data == 'withdraw_inr')
+@membership_required
 async def cb_withdraw_inr(query: types.CallbackQuery):
     await query.message.edit_text('💵 Enter withdrawal amount (INR):')
     await dp.current_state(user=query.from_user.id).set_state('awaiting_withdraw_inr')
 
 @dp.message_handler(state='awaiting_withdraw_usd')
+@membership_required
 async def handle_withdraw_usd(message: types.Message):
     ensure_user(message.from_user.id)
     try:
@@ -418,24 +1223,25 @@ async def handle_withdraw_usd(message: types.Message):
     await state.set_state('awaiting_withdraw_usdt_addr')
 
 @dp.message_handler(state='awaiting_withdraw_usdt_addr')
+@membership_required
 async def handle_withdraw_usdt_addr(message: types.Message):
     data = await dp.current_state(user=message.from_user.id).get_data()
     amt = data.get('withdraw_amount')
     addr = message.text.strip()
-    cur.execute('INSERT INTO withdrawals(user_id,method,amount,target,status,requested_at) VALUES(?,?,?,?,?,?)', (message.from_user.id, 'USDT_BEP20', amt, addr, 'pending', datetime.utcnow().isoformat()))
-    conn.commit()
+    requested_at = datetime.utcnow().isoformat()
+    cur.execute('INSERT INTO withdrawals(user_id,method,amount,target,status,requested_at) VALUES(?,?,?,?,?,?)', (message.from_user.id, 'USDT_BEP20', amt, addr, 'pending', requested_at))
     wid = cur.lastrowid
-    await message.answer('✅ Withdrawal requested and is pending admin approval.')
+    rollup_withdrawal(requested_at, 'USDT_BEP20', amt, None, 'pending')
     kb = InlineKeyboardMarkup()
     kb.add(InlineKeyboardButton('Approve', callback_data=f'admin_withdraw_approve:{wid}'), InlineKeyboardButton('Decline', callback_data=f'admin_withdraw_decline:{wid}'))
     for aid in ADMIN_IDS:
-        try:
-            await bot.send_message(aid, f'💸 New withdrawal #{wid}\nUser: {message.from_user.full_name} ({message.from_user.id})\nMethod: USDT_BEP20\nAmount: {amt}\nTarget: {addr}', reply_markup=kb)
-        except Exception:
-            pass
+        enqueue_message(aid, f'💸 New withdrawal #{wid}\nUser: {message.from_user.full_name} ({message.from_user.id})\nMethod: USDT_BEP20\nAmount: {amt}\nTarget: {addr}', reply_markup=kb)
+    conn.commit()
+    await message.answer('✅ Withdrawal requested and is pending admin approval.')
     await dp.current_state(user=message.from_user.id).reset_state()
 
 @dp.message_handler(state='awaiting_withdraw_inr')
+@membership_required
 async def handle_withdraw_inr(message: types.Message):
     ensure_user(message.from_user.id)
     try:
@@ -456,21 +1262,21 @@ async def handle_withdraw_inr(message: types.Message):
     await state.set_state('awaiting_withdraw_inr_upi')
 
 @dp.message_handler(state='awaiting_withdraw_inr_upi')
+@membership_required
 async def handle_withdraw_inr_upi(message: types.Message):
     data = await dp.current_state(user=message.from_user.id).get_data()
     amt = data.get('withdraw_amount')
     upi = message.text.strip()
-    cur.execute('INSERT INTO withdrawals(user_id,method,amount,target,status,requested_at) VALUES(?,?,?,?,?,?)', (message.from_user.id, 'INR_UPI', amt, upi, 'pending', datetime.utcnow().isoformat()))
-    conn.commit()
+    requested_at = datetime.utcnow().isoformat()
+    cur.execute('INSERT INTO withdrawals(user_id,method,amount,target,status,requested_at) VALUES(?,?,?,?,?,?)', (message.from_user.id, 'INR_UPI', amt, upi, 'pending', requested_at))
     wid = cur.lastrowid
-    await message.answer('✅ Withdrawal requested and is pending admin approval.')
+    rollup_withdrawal(requested_at, 'INR_UPI', amt, None, 'pending')
     kb = InlineKeyboardMarkup()
     kb.add(InlineKeyboardButton('Approve', callback_data=f'admin_withdraw_approve:{wid}'), InlineKeyboardButton('Decline', callback_data=f'admin_withdraw_decline:{wid}'))
     for aid in ADMIN_IDS:
-        try:
-            await bot.send_message(aid, f'💸 New withdrawal #{wid}\nUser: {message.from_user.full_name} ({message.from_user.id})\nMethod: INR_UPI\nAmount: {amt}\nTarget: {upi}', reply_markup=kb)
-        except Exception:
-            pass
+        enqueue_message(aid, f'💸 New withdrawal #{wid}\nUser: {message.from_user.full_name} ({message.from_user.id})\nMethod: INR_UPI\nAmount: {amt}\nTarget: {upi}', reply_markup=kb)
+    conn.commit()
+    await message.answer('✅ Withdrawal requested and is pending admin approval.')
     await dp.current_state(user=message.from_user.id).reset_state()
 
 # Admin approve/decline withdraw. Any admin can approve/decline.
@@ -491,254 +1297,399 @@ async def cb_admin_withdraw_action(query: types.CallbackQuery):
         return
     action = action_wrapped.split('_')[-1]
 
-    cur.execute('SELECT user_id,amount,method,status FROM withdrawals WHERE id=?', (wid,))
+    cur.execute('SELECT user_id,amount,method,status,requested_at FROM withdrawals_all WHERE id=?', (wid,))
     row = cur.fetchone()
     if not row:
         await query.answer('Request not found', show_alert=True)
         return
-    uid, amt, method, status = row
+    uid, amt, method, status, requested_at = row
+    if status != 'pending':
+        await query.answer('Already processed', show_alert=True)
+        return
 
     if action == 'approve':
-        if status != 'pending':
-            await query.answer('Already processed', show_alert=True)
-            return
-        # check user's current balance and deduct only the right currency
-        if method == 'USDT_BEP20':
-            cur.execute('SELECT balance_usd FROM users WHERE user_id=?', (uid,))
-            bal_row = cur.fetchone()
-            bal = bal_row[0] if bal_row else 0.0
-            if bal < amt:
-                cur.execute('UPDATE withdrawals SET status=? WHERE id=?', ('declined', wid))
-                conn.commit()
-                await query.message.edit_text('❌ Withdrawal declined — user has insufficient USD balance at processing time.')
-                try:
-                    await bot.send_message(uid, f'❌ Your withdrawal #{wid} was declined due to insufficient balance at processing time. Contact support.')
-                except Exception:
-                    pass
+        # Settle under one write lock: with shard workers another process may be approving
+        # the same request, so the status flip and the debit are both guarded updates.
+        conn.commit()
+        cur.execute('BEGIN IMMEDIATE')
+        try:
+            cur.execute("UPDATE withdrawals SET status=? WHERE id=? AND status='pending'", ('approved', wid))
+            if cur.rowcount != 1:
+                conn.rollback()
+                await query.answer('Already processed', show_alert=True)
                 return
-            cur.execute('UPDATE users SET balance_usd = balance_usd - ? WHERE user_id=?', (amt, uid))
-        else:
-            # INR
-            cur.execute('SELECT balance_inr FROM users WHERE user_id=?', (uid,))
-            bal_row = cur.fetchone()
-            bal = bal_row[0] if bal_row else 0.0
-            if bal < amt:
+            # deduct only the right currency, and only if the balance still covers it
+            balance_col, currency = ('balance_usd', 'USD') if method == 'USDT_BEP20' else ('balance_inr', 'INR')
+            cur.execute(f'UPDATE users SET {balance_col} = {balance_col} - ? WHERE user_id=? AND {balance_col} >= ?', (amt, uid, amt))
+            if cur.rowcount != 1:
                 cur.execute('UPDATE withdrawals SET status=? WHERE id=?', ('declined', wid))
+                rollup_withdrawal(requested_at, method, amt, 'pending', 'declined')
+                enqueue_message(uid, f'❌ Your withdrawal #{wid} was declined due to insufficient balance at processing time. Contact support.')
                 conn.commit()
-                await query.message.edit_text('❌ Withdrawal declined — user has insufficient INR balance at processing time.')
-                try:
-                    await bot.send_message(uid, f'❌ Your withdrawal #{wid} was declined due to insufficient balance at processing time. Contact support.')
-                except Exception:
-                    pass
+                await query.message.edit_text(f'❌ Withdrawal declined — user has insufficient {currency} balance at processing time.')
                 return
-            cur.execute('UPDATE users SET balance_inr = balance_inr - ? WHERE user_id=?', (amt, uid))
-
-        cur.execute('UPDATE withdrawals SET status=? WHERE id=?', ('approved', wid))
-        conn.commit()
-        await query.message.edit_text('✅ Withdrawal approved.')
-        try:
-            await bot.send_message(uid, f'✅ Your withdrawal #{wid} has been approved. Amount: {amt} ({method})')
+            rollup_withdrawal(requested_at, method, amt, 'pending', 'approved')
+            enqueue_message(uid, f'✅ Your withdrawal #{wid} has been approved. Amount: {amt} ({method})')
+            conn.commit()
         except Exception:
-            pass
+            conn.rollback()
+            raise
+        await query.message.edit_text('✅ Withdrawal approved.')
     else:
-        cur.execute('UPDATE withdrawals SET status=? WHERE id=?', ('declined', wid))
+        # same guard as approve: a stale button (or an archived row) must not decline twice
         conn.commit()
-        await query.message.edit_text('❌ Withdrawal declined.')
+        cur.execute('BEGIN IMMEDIATE')
         try:
-            await bot.send_message(uid, f'❌ Your withdrawal #{wid} has been declined. Contact support.')
+            cur.execute("UPDATE withdrawals SET status=? WHERE id=? AND status='pending'", ('declined', wid))
+            if cur.rowcount != 1:
+                conn.rollback()
+                await query.answer('Already processed', show_alert=True)
+                return
+            rollup_withdrawal(requested_at, method, amt, 'pending', 'declined')
+            enqueue_message(uid, f'❌ Your withdrawal #{wid} has been declined. Contact support.')
+            conn.commit()
         except Exception:
-            pass
+            conn.rollback()
+            raise
+        await query.message.edit_text('❌ Withdrawal declined.')
 
 # ---------- BACK handler ----------
 @dp.callback_query_handler(lambda c: c.data == 'back')
 async def cb_back(query: types.CallbackQuery):
     await query.message.edit_text('Choose an option:', reply_markup=main_menu_kb())
 
-# ---------- GROUP SELL FLOW ----------
-@dp.message_handler(regexp=r't.me/|telegram.me/|\+\w{8,}')
-async def handle_group_link(message: types.Message):
-    ensure_user(message.from_user.id)
-    if MAINTENANCE and not is_admin(message.from_user.id):
-        await message.answer('⚠️ Bot is under maintenance. Please try later.')
+# ---------- GROUP PEER CACHE ----------
+# link -> (peer id, access hash), filled on first resolve so later sell steps can build
+# an InputPeer without another username/invite resolution RPC.
+UNREACHABLE_ERRORS = (errors.ChannelPrivateError, errors.ChannelInvalidError, errors.ChatIdInvalidError,
+                      errors.PeerIdInvalidError, errors.ChatForbiddenError, errors.UserBannedInChannelError)
+
+def cache_group_peer(link: str, entity):
+    peer = utils.get_input_peer(entity)
+    if isinstance(peer, InputPeerChannel):
+        row = ('channel', peer.channel_id, peer.access_hash)
+    elif isinstance(peer, InputPeerChat):
+        row = ('chat', peer.chat_id, 0)
+    else:
         return
+    cur.execute('REPLACE INTO peer_cache(link,peer_type,peer_id,access_hash,resolved_at) VALUES(?,?,?,?,?)',
+                (link,) + row + (datetime.utcnow().isoformat(),))
+    conn.commit()
 
-    link = message.text.strip()
-    pending_msg = await message.answer('⏳ Checking Group Details...')
+def cached_group_peer(link: str):
+    cur.execute('SELECT peer_type,peer_id,access_hash FROM peer_cache WHERE link=?', (link,))
+    r = cur.fetchone()
+    if not r:
+        return None
+    return InputPeerChannel(r[1], r[2]) if r[0] == 'channel' else InputPeerChat(r[1])
 
-    try:
-        await ensure_telethon_client()
-    except Exception as e:
-        await pending_msg.edit_text('❌ Telethon userbot not ready: ' + str(e))
-        return
+def forget_group_peer(link: str):
+    cur.execute('DELETE FROM peer_cache WHERE link=?', (link,))
+    conn.commit()
 
+async def group_peer(link: str):
+    peer = cached_group_peer(link)
+    if peer is not None:
+        return peer
+    entity = await telethon_client.get_entity(link)
+    cache_group_peer(link, entity)
+    return utils.get_input_peer(entity)
+
+# ---------- GROUP SELL FLOW ----------
+# One message may carry many links; they are appraised concurrently and sold as one
+# multi-item transfer. The userbot work lives in the USERBOT_OPS below, reached through
+# userbot_call; userbot_slots keeps at most SELL_CONCURRENCY of them in flight.
+SELL_CONCURRENCY = int(os.getenv('SELL_CONCURRENCY') or 5)
+userbot_slots = asyncio.Semaphore(SELL_CONCURRENCY)
+MAX_LINKS_PER_SUBMISSION = 25
+LINK_TOKEN_RE = re.compile(r'(?:https?://)?(?:t\.me|telegram\.me)/\S+|\+\w{8,}')
+
+def extract_links(text: str):
+    links = {}
+    for link in LINK_TOKEN_RE.findall(text):
+        links.setdefault(re.sub(r'^https?://', '', link).rstrip('/'), link)
+    return list(links.values()) or [text.strip()]
+
+def price_for_year(price_list, year_label: str):
+    for label, inr, usd in price_list:
+        if '2023' in label and '2023' in year_label:
+            return (label, inr, usd)
+    return price_list[0] if price_list else ('Default', 0.0, 0.0)
+
+async def resolve_group_entity(link: str):
     # try to resolve entity; Telethon will raise if not member and not invite
-    entity = None
+    cached = cached_group_peer(link)
+    if cached is not None:
+        try:
+            return await telethon_client.get_entity(cached)
+        except Exception:
+            forget_group_peer(link)
     try:
-        entity = await telethon_client.get_entity(link)
+        return await telethon_client.get_entity(link)
     except Exception:
-        # try invite join
+        pass
+    # try invite join
+    m = re.search(r'(?:t\.me/\+|joinchat/)([A-Za-z0-9_-]+)', link)
+    if not m:
+        return None
+    try:
+        await telethon_client(CheckChatInviteRequest(m.group(1)))
         try:
-            m = re.search(r'(?:t\.me/\+|joinchat/)([A-Za-z0-9_-]+)', link)
-            invite_hash = m.group(1) if m else None
-            if invite_hash:
-                try:
-                    await telethon_client(CheckChatInviteRequest(invite_hash))
-                    try:
-                        await telethon_client(ImportChatInviteRequest(invite_hash))
-                    except Exception:
-                        pass
-                    entity = await telethon_client.get_entity(link)
-                except Exception:
-                    pass
+            await telethon_client(ImportChatInviteRequest(m.group(1)))
         except Exception:
             pass
+        return await telethon_client.get_entity(link)
+    except Exception:
+        return None
 
-    if entity is None:
-        await pending_msg.edit_text('❌ Failed to resolve group. Ensure group link is valid and the userbot can access it.')
+async def appraise_group(link: str, price_list):
+    await ensure_telethon_client()
+    async with userbot_slots:
+        entity = await resolve_group_entity(link)
+        if entity is None:
+            raise Exception('Failed to resolve group. Ensure group link is valid and the userbot can access it.')
+        cache_group_peer(link, entity)
+        try:
+            history = await telethon_client.get_messages(entity, limit=200)
+        except Exception:
+            raise Exception('Unable to read messages from the group.')
+    earliest = history[-1].date if history else datetime.utcnow()
+    year_label = earliest.strftime('%b %Y')
+    tier, price_inr, price_usd = price_for_year(price_list, year_label)
+    return dict(link=link, peer_id=getattr(entity, 'id', None), title=getattr(entity, 'title', str(entity)), year_label=year_label,
+                first_message=earliest.strftime('%B %Y'), messages_count=len(history),
+                tier=tier, price_inr=price_inr, price_usd=price_usd)
+
+async def userbot_is_admin(link: str) -> bool:
+    await ensure_telethon_client()
+    me = userbot_me
+    async with userbot_slots:
+        try:
+            entity = await group_peer(link)
+            try:
+                admins = await telethon_client.get_participants(entity, filter=ChannelParticipantsAdmins())
+                return any(getattr(a, 'id', None) == me.id for a in admins)
+            except UNREACHABLE_ERRORS:
+                raise
+            except Exception:
+                # some chats don't expose the admin filter; fall back to membership
+                participants = await telethon_client.get_participants(entity, limit=300)
+                return any(getattr(p, 'id', None) == me.id for p in participants)
+        except UNREACHABLE_ERRORS:
+            forget_group_peer(link)
+            return False
+        except Exception:
+            return False
+
+async def leave_group(link: str):
+    await ensure_telethon_client()
+    async with userbot_slots:
+        try:
+            await telethon_client(LeaveChannelRequest(await group_peer(link)))
+        except Exception:
+            pass
+    # the userbot is no longer a member, so the cached peer is stale
+    forget_group_peer(link)
+
+async def userbot_name() -> str:
+    await ensure_telethon_client()
+    me = userbot_me
+    return (me.username or me.first_name or 'admin') if me else 'admin'
+
+def sell_quote_text(items, failures):
+    total = sum(it['price_inr'] for it in items)
+    if len(items) == 1 and not failures:
+        it = items[0]
+        return f"🔹 Group: {it['year_label']}\n🛡️ Status: Private supergroup\n🕒 First message: {it['first_message']}\n💬 Messages: {it['messages_count']}\n💰 Price: {format_currency_inr(it['price_inr'])}\n\n💰 Total price: {format_currency_inr(total)}\n\n👇 Choose an option:"
+    text = ''
+    for i, it in enumerate(items, 1):
+        text += f"{i}. 🔹 {it['title']} — {it['year_label']} — 💬 {it['messages_count']} — 💰 {format_currency_inr(it['price_inr'])}\n"
+    if failures:
+        text += '\n⚠️ Skipped:\n' + ''.join(f'• {link}: {err}\n' for link, err in failures)
+    return text + f"\n💰 Total price ({len(items)} groups): {format_currency_inr(total)}\n\n👇 Choose an option:"
+
+@dp.message_handler(regexp=r't.me/|telegram.me/|\+\w{8,}')
+@membership_required
+async def handle_group_link(message: types.Message):
+    ensure_user(message.from_user.id)
+    if maintenance_on() and not is_admin(message.from_user.id):
+        await message.answer('⚠️ Bot is under maintenance. Please try later.')
         return
 
+    links = extract_links(message.text)
+    if len(links) > MAX_LINKS_PER_SUBMISSION:
+        await message.answer(f'❌ Send at most {MAX_LINKS_PER_SUBMISSION} links per message.')
+        return
+    pending_msg = await message.answer('⏳ Checking Group Details...' if len(links) == 1 else f'⏳ Checking {len(links)} groups...')
+
     try:
-        title = getattr(entity, 'title', str(entity))
-        history = await telethon_client.get_messages(entity, limit=200)
-        messages_count = len(history)
-        earliest = history[-1].date if history else datetime.utcnow()
-        year_label = earliest.strftime('%b %Y')
-    except Exception:
-        await pending_msg.edit_text('❌ Unable to read messages from the group.')
+        await userbot_call('ensure_telethon_client')
+    except Exception as e:
+        await pending_msg.edit_text('❌ Telethon userbot not ready: ' + str(e))
         return
 
     price_list = parse_price_list(get_setting('price_list'))
-    chosen = None
-    for label, inr, usd in price_list:
-        if '2023' in label and '2023' in year_label:
-            chosen = (label, inr, usd)
-            break
-    if not chosen:
-        chosen = price_list[0] if price_list else ('Default', 0.0, 0.0)
-
-    price_inr = chosen[1]
-    price_usd = chosen[2]
-
-    text = f"🔹 Group: {year_label}\n🛡️ Status: Private supergroup\n🕒 First message: {earliest.strftime('%B %Y')}\n💬 Messages: {messages_count}\n💰 Price: {format_currency_inr(price_inr)}\n\n💰 Total price: {format_currency_inr(price_inr)}\n\n👇 Choose an option:"
-
-    transfer_key = make_transfer_key(message.from_user.id, link)
-    store_pending_transfer(transfer_key, link, price_inr, price_usd, title, expires_minutes=15)
+    results = await asyncio.gather(*(userbot_call('appraise_group', link, price_list) for link in links), return_exceptions=True)
+    failures = [(link, str(r)) for link, r in zip(links, results) if isinstance(r, Exception)]
+    # different spellings of one link (case, telegram.me, joinchat/ vs +) resolve to the same group
+    items, seen = [], {}
+    for it in (r for r in results if not isinstance(r, Exception)):
+        if it['peer_id'] in seen:
+            failures.append((it['link'], f"Same group as {seen[it['peer_id']]}."))
+        else:
+            seen[it['peer_id']] = it['link']
+            items.append(it)
+    transfer_key = make_transfer_key(message.from_user.id, ' '.join(it['link'] for it in items))
+    rejected = store_pending_transfer(transfer_key, message.from_user.id, items, expires_minutes=15) if items else []
+    failures += [(it['link'], reason) for it, reason in rejected]
+    items = [it for it in items if not any(it is r for r, _ in rejected)]
+    if not items:
+        if len(failures) == 1:
+            await pending_msg.edit_text('❌ ' + failures[0][1])
+        else:
+            await pending_msg.edit_text('❌ None of the groups can be sold:\n' + ''.join(f'• {link}: {err}\n' for link, err in failures))
+        return
 
     kb = InlineKeyboardMarkup()
     kb.add(InlineKeyboardButton('✅ Confirm', callback_data=f'confirm_sell:{transfer_key}'), InlineKeyboardButton('🚫 Cancel', callback_data=f'cancel_sell:{transfer_key}'))
-    await pending_msg.edit_text(text, reply_markup=kb)
+    await pending_msg.edit_text(sell_quote_text(items, failures), reply_markup=kb)
 
 @dp.callback_query_handler(lambda c: c.data and c.data.startswith('cancel_sell:'))
 async def cb_cancel_sell(query: types.CallbackQuery):
-    # on cancel, try to remove userbot from the group (leave) to ensure no lingering membership
+    # on cancel, try to remove userbot from the groups (leave) to ensure no lingering membership
     try:
         transfer_key = query.data.split(':', 1)[1]
     except Exception:
         transfer_key = None
     if transfer_key:
         pending = load_pending_transfer(transfer_key)
-        if pending:
+        if pending and pending['user_id'] == query.from_user.id and clear_pending_transfer(transfer_key, 'cancelled'):
             try:
-                # attempt to get entity and leave
-                await ensure_telethon_client()
-                ent = await telethon_client.get_entity(pending['link'])
-                try:
-                    await telethon_client(LeaveChannelRequest(ent))
-                except Exception:
-                    pass
-                clear_pending_transfer(transfer_key)
+                await asyncio.gather(*(userbot_call('leave_group', it['link']) for it in pending['items'] if not it['sold']))
             except Exception:
                 pass
+        else:
+            status = transfer_status(transfer_key)
+            if status == 'verifying':
+                await query.answer('⏳ Ownership check in progress, try again in a moment.', show_alert=True)
+                return
+            if status == 'sold':
+                await query.answer('✅ This transfer is already completed.', show_alert=True)
+                return
     await query.message.edit_text('❌ Cancelled — transfer aborted and userbot left the chat (if it was joined).')
 
 @dp.callback_query_handler(lambda c: c.data and c.data.startswith('confirm_sell:'))
+@membership_required
 async def cb_confirm_sell(query: types.CallbackQuery):
     try:
         transfer_key = query.data.split(':', 1)[1]
     except Exception:
         await query.answer('Invalid payload', show_alert=True)
         return
+    if not await transfer_single_flight(transfer_key, 'confirm', lambda: confirm_transfer(query, transfer_key)):
+        await query.answer()
 
+async def confirm_transfer(query: types.CallbackQuery, transfer_key: str):
     pending = load_pending_transfer(transfer_key)
-    if not pending:
+    if not pending or pending['user_id'] != query.from_user.id:
         await query.answer('No pending transfer found or time expired.', show_alert=True)
         return
 
-    link = pending['link']
-    price_inr = pending['price_inr']
-    price_usd = pending['price_usd']
-    title = pending['title']
-
     try:
-        me = await telethon_client.get_me()
-        admin_name = me.username or me.first_name or 'admin'
+        admin_name = await userbot_call('userbot_name')
     except Exception:
         admin_name = 'admin'
 
-    text = f"⚡ Ownership Transfer Required\nTransfer each group to its assigned userbot, then tap Verify to confirm.\n\n⏳ You have 15 minutes to complete this step.\n\n1. {title} ({link}) -> {admin_name}\n"
+    text = "⚡ Ownership Transfer Required\nTransfer each group to its assigned userbot, then tap Verify to confirm.\n\n⏳ You have 15 minutes to complete this step.\n\n"
+    text += ''.join(f"{i}. {it['title']} ({it['link']}) -> {admin_name}\n" for i, it in enumerate(pending['items'], 1))
     kb = InlineKeyboardMarkup()
     kb.add(InlineKeyboardButton('✅ Verify', callback_data=f'verify_transfer:{transfer_key}'), InlineKeyboardButton('❌ Cancel', callback_data=f'cancel_sell:{transfer_key}'))
     await query.message.edit_text(text, reply_markup=kb)
 
 @dp.callback_query_handler(lambda c: c.data and c.data.startswith('verify_transfer:'))
+@membership_required
 async def cb_verify_transfer(query: types.CallbackQuery):
     try:
         transfer_key = query.data.split(':', 1)[1]
     except Exception:
         await query.answer('Invalid payload', show_alert=True)
         return
-
-    pending = load_pending_transfer(transfer_key)
-    if not pending:
-        await query.answer('No pending transfer found or time expired.', show_alert=True)
-        return
-
-    if datetime.utcnow() > datetime.fromisoformat(pending['exp']):
-        clear_pending_transfer(transfer_key)
-        await query.message.edit_text('❌ Ownership transfer time expired. Cancelled.')
+    if not await transfer_single_flight(transfer_key, 'verify', lambda: verify_transfer(query, transfer_key)):
+        await query.answer('⏳ Already checking this transfer...')
+
+async def verify_transfer(query: types.CallbackQuery, transfer_key: str):
+    token = begin_verify(transfer_key)
+    if token is None:
+        if transfer_status(transfer_key) == 'verifying':
+            await query.answer('⏳ Already checking this transfer...')
+        else:
+            await query.answer('No pending transfer found or time expired.', show_alert=True)
         return
+    try:
+        pending = load_pending_transfer(transfer_key, 'verifying')
+        if not pending or pending['user_id'] != query.from_user.id:
+            await query.answer('No pending transfer found or time expired.', show_alert=True)
+            return
 
-    link = pending['link']
-    price_inr = pending['price_inr']
-    price_usd = pending['price_usd']
-    title = pending['title']
+        if datetime.utcnow() > datetime.fromisoformat(pending['exp']):
+            transition_transfer(transfer_key, 'verifying', 'expired', token)
+            token = None
+            await query.message.edit_text('❌ Ownership transfer time expired. Cancelled.')
+            return
 
-    await query.message.edit_text('⏳ Checking ownership...')
-    try:
-        await ensure_telethon_client()
-        entity = await telethon_client.get_entity(link)
-        # check whether telethon_client is in admins of the chat
-        participants = await telethon_client.get_participants(entity, limit=300)
-        me = await telethon_client.get_me()
-        is_admin = any(getattr(p, 'id', None) == getattr(me, 'id', None) for p in participants if getattr(p, 'id', None) is not None and getattr(p, 'bot', False) is False or True)
-        # Note: sometimes participants are not annotated as admin; we'll also try to fetch full admin list via iter_participants with filter if necessary.
-        # More robust check:
+        await query.message.edit_text('⏳ Checking ownership...')
+        todo = [it for it in pending['items'] if not it['sold']]
         try:
-            from telethon.tl.types import ChannelParticipantsAdmins
-            admins = await telethon_client.get_participants(entity, filter=ChannelParticipantsAdmins())
-            is_admin = any(getattr(a, 'id', None) == getattr(me, 'id', None) for a in admins)
+            await userbot_call('ensure_telethon_client')
+            verdicts = await asyncio.gather(*(userbot_call('userbot_is_admin', it['link']) for it in todo))
         except Exception:
-            pass
-    except Exception:
-        is_admin = False
-
-    if not is_admin:
-        await query.message.edit_text(f'❌ Ownership not transferred for:\n1. {title} ({link})\n\n⏳ Time remains. Tap "✅ Verify" after transferring ownership.')
-        return
+            verdicts = [False] * len(todo)
+        verified = [it for it, ok in zip(todo, verdicts) if ok]
+        remaining = [it for it, ok in zip(todo, verdicts) if not ok]
+
+        kb = InlineKeyboardMarkup()
+        kb.add(InlineKeyboardButton('✅ Verify', callback_data=f'verify_transfer:{transfer_key}'), InlineKeyboardButton('❌ Cancel', callback_data=f'cancel_sell:{transfer_key}'))
+        not_done = ''.join(f"{i}. {it['title']} ({it['link']})\n" for i, it in enumerate(remaining, 1))
+        if not verified:
+            transition_transfer(transfer_key, 'verifying', 'pending', token)
+            token = None
+            await query.message.edit_text(f'❌ Ownership not transferred for:\n{not_done}\n⏳ Time remains. Tap "✅ Verify" after transferring ownership.', reply_markup=kb)
+            return
 
-    # success -> mark sold and credit only once
-    sold_at = datetime.utcnow().isoformat()
-    cur.execute('INSERT INTO sold_groups(user_id,group_link,group_title,group_year,messages_count,price_usd,price_inr,sold_at) VALUES(?,?,?,?,?,?,?,?)',
-                (query.from_user.id, link, title, title, 0, price_usd, price_inr, sold_at))
-    # credit only those currency balances; don't double-credit
-    cur.execute('UPDATE users SET balance_usd = balance_usd + ?, balance_inr = balance_inr + ? WHERE user_id=?', (price_usd, price_inr, query.from_user.id))
-    conn.commit()
-    clear_pending_transfer(transfer_key)
+        # success -> settle the transfer, mark verified items sold and credit them in one transaction
+        flush_new_users()
+        if transition_transfer(transfer_key, 'verifying', 'pending' if remaining else 'sold', token, commit=False) is None:
+            # a stale takeover already owns this transfer; let it finish. The zero-row UPDATE
+            # still opened a write transaction, so end it rather than hold the lock.
+            token = None
+            conn.rollback()
+            await query.answer('⏳ Already checking this transfer...')
+            return
+        sold_at = datetime.utcnow().isoformat()
+        for it in verified:
+            cur.execute('INSERT INTO sold_groups(user_id,group_link,group_title,group_year,messages_count,price_usd,price_inr,sold_at,price_tier,group_peer_id) VALUES(?,?,?,?,?,?,?,?,?,?)',
+                        (pending['user_id'], it['link'], it['title'], it['year_label'], it['messages_count'], it['price_usd'], it['price_inr'], sold_at, it['tier'], it['peer_id']))
+            rollup_sale(sold_at, it['tier'], it['price_usd'], it['price_inr'])
+            cur.execute('UPDATE transfer_items SET sold=1 WHERE id=?', (it['id'],))
+        price_usd = sum(it['price_usd'] for it in verified)
+        price_inr = sum(it['price_inr'] for it in verified)
+        cur.execute('UPDATE users SET balance_usd = balance_usd + ?, balance_inr = balance_inr + ? WHERE user_id=?', (price_usd, price_inr, pending['user_id']))
+        conn.commit()
+        token = None
+    finally:
+        if token is not None:
+            conn.rollback()
+            transition_transfer(transfer_key, 'verifying', 'pending', token)
 
-    cur.execute('SELECT balance_usd, balance_inr FROM users WHERE user_id=?', (query.from_user.id,))
+    cur.execute('SELECT balance_usd, balance_inr FROM users WHERE user_id=?', (pending['user_id'],))
     b = cur.fetchone() or (0.0, 0.0)
-    msg = f"✅ Group Sold!\n\nGroup: {title}\nPrice: {format_currency_inr(price_inr)}/{format_currency_usd(price_usd)}\nDate: {sold_at[:19]}\nAccount balance: {format_currency_inr(b[1])}/{format_currency_usd(b[0])}"
-    await query.message.edit_text(msg)
+    groups = verified[0]['title'] if len(verified) == 1 else ', '.join(it['title'] for it in verified)
+    msg = f"✅ {'Group' if len(verified) == 1 else f'{len(verified)} Groups'} Sold!\n\nGroup: {groups}\nPrice: {format_currency_inr(price_inr)}/{format_currency_usd(price_usd)}\nDate: {sold_at[:19]}\nAccount balance: {format_currency_inr(b[1])}/{format_currency_usd(b[0])}"
+    if remaining:
+        msg += f'\n\n❌ Ownership not transferred yet for:\n{not_done}\n⏳ Tap "✅ Verify" after transferring the rest.'
+        await query.message.edit_text(msg, reply_markup=kb)
+    else:
+        await query.message.edit_text(msg)
 
 # ---------- ADMIN PANEL ----------
 @dp.callback_query_handler(lambda c: c.data == 'admin_panel')
@@ -753,6 +1704,8 @@ async def cb_admin_panel(query: types.CallbackQuery):
     kb.add(InlineKeyboardButton('Broadcast', callback_data='admin_broadcast'))
     kb.add(InlineKeyboardButton('Toggle Maintenance', callback_data='admin_toggle_maint'))
     kb.add(InlineKeyboardButton('User Management', callback_data='admin_user_mgmt'))
+    kb.add(InlineKeyboardButton('Support Inbox', callback_data='admin_inbox:0'))
+    kb.add(InlineKeyboardButton('Outbox', callback_data='admin_outbox'))
     await query.message.edit_text('Admin Panel', reply_markup=kb)
 
 @dp.callback_query_handler(lambda c: c.data == 'admin_set_prices')
@@ -805,7 +1758,16 @@ async def handle_admin_channel(message: types.Message):
         await message.answer('Unauthorized')
         await dp.current_state(user=message.from_user.id).reset_state()
         return
-    set_setting('mandatory_channel', message.text.strip())
+    channel = (message.text or '').strip()
+    try:
+        # the gate needs getChatMember to work: the chat must exist and the bot must see its members
+        await bot.get_chat_member(channel, message.from_user.id)
+    except (BadRequest, Unauthorized) as e:
+        await message.answer(f'❌ Cannot check members of {channel}: {e}\nUse a public @channel where the bot is an admin.')
+        await dp.current_state(user=message.from_user.id).reset_state()
+        return
+    set_setting('mandatory_channel', channel)
+    invalidate_membership_cache()
     await message.answer('✅ Mandatory channel updated.')
     await dp.current_state(user=message.from_user.id).reset_state()
 
@@ -823,16 +1785,13 @@ async def handle_admin_broadcast(message: types.Message):
         await message.answer('Unauthorized')
         await dp.current_state(user=message.from_user.id).reset_state()
         return
+    flush_new_users()
     cur.execute('SELECT user_id FROM users')
     users = [r[0] for r in cur.fetchall()]
-    sent = 0
     for uid in users:
-        try:
-            await bot.send_message(uid, message.text)
-            sent += 1
-        except Exception:
-            pass
-    await message.answer(f'Broadcast sent to {sent} users.')
+        enqueue_message(uid, message.text)
+    conn.commit()
+    await message.answer(f'Broadcast queued for {len(users)} users.')
     await dp.current_state(user=message.from_user.id).reset_state()
 
 @dp.callback_query_handler(lambda c: c.data == 'admin_toggle_maint')
@@ -840,10 +1799,23 @@ async def cb_admin_toggle_maint(query: types.CallbackQuery):
     if not is_admin(query.from_user.id):
         await query.answer('Unauthorized', show_alert=True)
         return
-    global MAINTENANCE
-    MAINTENANCE = not MAINTENANCE
-    set_setting('maintenance', '1' if MAINTENANCE else '0')
-    await query.message.edit_text(f'Maintenance mode is now {"ON" if MAINTENANCE else "OFF"}.')
+    enabled = not maintenance_on()
+    set_setting('maintenance', '1' if enabled else '0')
+    await query.message.edit_text(f'Maintenance mode is now {"ON" if enabled else "OFF"}.')
+
+@dp.callback_query_handler(lambda c: c.data in ('admin_outbox', 'admin_outbox_requeue'))
+async def cb_admin_outbox(query: types.CallbackQuery):
+    if not is_admin(query.from_user.id):
+        await query.answer('Unauthorized', show_alert=True)
+        return
+    if query.data == 'admin_outbox_requeue':
+        cur.execute("UPDATE outbox SET status='pending', attempts=0, next_attempt_at=? WHERE status='dead'", (time.time(),))
+        conn.commit()
+        outbox_wakeup.set()
+    update_outbox_metrics()
+    text = f"📤 Outbox\nLag: {outbox_metrics['lag_seconds']:.1f}s\nPending: {outbox_metrics['pending']}\nDead-lettered: {outbox_metrics['dead']}"
+    kb = InlineKeyboardMarkup().add(InlineKeyboardButton('Requeue dead', callback_data='admin_outbox_requeue'))
+    await query.message.answer(text, reply_markup=kb)
 
 # Admin command and reply keyboard
 @dp.message_handler(commands=['admin'])
@@ -865,6 +1837,8 @@ async def admin_panel_button(message: types.Message):
     kb.add(InlineKeyboardButton('Broadcast', callback_data='admin_broadcast'))
     kb.add(InlineKeyboardButton('Toggle Maintenance', callback_data='admin_toggle_maint'))
     kb.add(InlineKeyboardButton('User Management', callback_data='admin_user_mgmt'))
+    kb.add(InlineKeyboardButton('Support Inbox', callback_data='admin_inbox:0'))
+    kb.add(InlineKeyboardButton('Outbox', callback_data='admin_outbox'))
     await message.reply('Admin Panel', reply_markup=kb)
 
 # Admin user management flows (same approach as earlier but for multiple admins)
@@ -873,7 +1847,7 @@ async def cb_admin_user_mgmt(query: types.CallbackQuery):
     if not is_admin(query.from_user.id):
         await query.answer('Unauthorized', show_alert=True)
         return
-    await query.message.answer('Send the user ID you want to manage (integer):')
+    await query.message.answer('Send the user ID, @username or name you want to manage:')
     await dp.current_state(user=query.from_user.id).set_state('admin_user_mgmt_await_id')
 
 @dp.message_handler(state='admin_user_mgmt_await_id')
@@ -882,29 +1856,48 @@ async def handle_admin_user_mgmt_id(message: types.Message):
         await message.reply('Unauthorized')
         await dp.current_state(user=message.from_user.id).reset_state()
         return
-    try:
-        uid = int(re.sub(r'[^0-9]', '', message.text))
-    except Exception:
-        await message.reply('Invalid user id. Send a numeric Telegram user id.')
+    flush_new_users()
+    text = message.text or ''
+    digits = re.sub(r'[^0-9]', '', text)
+    if digits and not re.search(r'[^\W\d_]', text):
+        uid = int(digits)
+    else:
+        # @username or display name
+        matches = []
+        if fts_query(text):
+            cur.execute('SELECT u.user_id, u.username, u.full_name FROM users_fts f JOIN users u ON u.user_id = f.rowid '
+                        'WHERE users_fts MATCH ? ORDER BY rank LIMIT 10', (fts_query(text),))
+            matches = cur.fetchall()
+        if len(matches) > 1:
+            # stay in this state: the admin taps one of the matches or sends the numeric id
+            kb = InlineKeyboardMarkup()
+            for r in matches:
+                kb.add(InlineKeyboardButton(f"{r[0]} @{r[1] or '-'} {r[2] or ''}".strip(), callback_data=f'admin_user_pick:{r[0]}'))
+            await message.reply(f'{len(matches)} users match. Pick one or send the numeric id:', reply_markup=kb)
+            return
+        uid = matches[0][0] if matches else None
+    card = user_card(uid) if uid is not None else None
+    if not card:
+        await message.reply('User not found.')
         await dp.current_state(user=message.from_user.id).reset_state()
         return
-    ensure_user(uid)
+    await message.reply(card[0], reply_markup=card[1])
+    await dp.current_state(user=message.from_user.id).reset_state()
+
+def user_card(uid: int):
     cur.execute('SELECT user_id,balance_usd,balance_inr,joined_at FROM users WHERE user_id=?', (uid,))
     row = cur.fetchone()
     if not row:
-        await message.reply('User not found.')
-        await dp.current_state(user=message.from_user.id).reset_state()
-        return
+        return None
     uid, bal_usd, bal_inr, joined_at = row
     text = f'User: {uid}\nBalance USD: {format_currency_usd(bal_usd)}\nBalance INR: {format_currency_inr(bal_inr)}\nJoined: {joined_at}'
     kb = InlineKeyboardMarkup()
     kb.add(InlineKeyboardButton('Add Balance', callback_data=f'admin_user_add:{uid}'), InlineKeyboardButton('Subtract Balance', callback_data=f'admin_user_sub:{uid}'))
     kb.add(InlineKeyboardButton('Set Balance', callback_data=f'admin_user_set:{uid}'))
     kb.add(InlineKeyboardButton('Show Withdrawals', callback_data=f'admin_user_wd:{uid}'))
-    await message.reply(text, reply_markup=kb)
-    await dp.current_state(user=message.from_user.id).reset_state()
+    return text, kb
 
-@dp.callback_query_handler(lambda c: c.data and c.data.startswith('admin_user_'))
+@dp.callback_query_handler(lambda c: c.data and c.data.startswith('admin_user_') and ':' in c.data, state='*')
 async def cb_admin_user_actions(query: types.CallbackQuery):
     if not is_admin(query.from_user.id):
         await query.answer('Unauthorized', show_alert=True)
@@ -915,14 +1908,21 @@ async def cb_admin_user_actions(query: types.CallbackQuery):
         await query.answer('Invalid payload', show_alert=True)
         return
     uid = int(parts[1])
-    if action in ('add', 'sub'):
+    if action == 'pick':
+        await dp.current_state(user=query.from_user.id).reset_state()
+        card = user_card(uid)
+        if not card:
+            await query.answer('User not found.', show_alert=True)
+            return
+        await query.message.answer(card[0], reply_markup=card[1])
+    elif action in ('add', 'sub'):
         await query.message.answer(f'Enter amount and currency type to {action} (example: 100 USD OR 500 INR):')
         await dp.current_state(user=query.from_user.id).set_state(f'admin_user_{action}_await:{uid}')
     elif action == 'set':
         await query.message.answer('Enter balances to set in format: <USD_amount> <INR_amount> (example: 10 750):')
         await dp.current_state(user=query.from_user.id).set_state(f'admin_user_set_await:{uid}')
     elif action == 'wd':
-        cur.execute('SELECT id,method,amount,status,requested_at FROM withdrawals WHERE user_id=? ORDER BY requested_at DESC', (uid,))
+        cur.execute('SELECT id,method,amount,status,requested_at FROM withdrawals_all WHERE user_id=? ORDER BY requested_at DESC', (uid,))
         rows = cur.fetchall()
         if not rows:
             await query.message.answer('No withdrawals found for this user.')
@@ -956,6 +1956,7 @@ async def handle_admin_user_add_sub(message: types.Message):
         return
     cur_action = 'add' if st.startswith('admin_user_add_await:') else 'sub'
     currency = t[1].upper()
+    flush_new_users()
     if currency == 'USD':
         if cur_action == 'add':
             cur.execute('UPDATE users SET balance_usd = balance_usd + ? WHERE user_id=?', (amt, uid))
@@ -993,23 +1994,168 @@ async def handle_admin_user_set(message: types.Message):
         await message.reply('Invalid numbers')
         await dp.current_state(user=message.from_user.id).reset_state()
         return
+    flush_new_users()
     cur.execute('UPDATE users SET balance_usd=?, balance_inr=? WHERE user_id=?', (usd_amt, inr_amt, uid))
     conn.commit()
     await message.reply(f'Balances set for user {uid}.')
     await dp.current_state(user=message.from_user.id).reset_state()
 
-# ---------- TELETHON USERBOT START HELPER ----------
-async def ensure_telethon_client():
-    global telethon_client
-    if telethon_client and getattr(telethon_client, 'is_connected', lambda: False)():
-        return
+# ---------- TELETHON USERBOT SUPERVISOR ----------
+# userbot_supervisor owns the client: it connects at startup, pings every
+# USERBOT_KEEPALIVE seconds and reconnects with exponential backoff. Handlers call
+# ensure_telethon_client, which only waits (bounded) for userbot_ready; client
+# creation always happens under userbot_lock, so there is never more than one client.
+USERBOT_KEEPALIVE = float(os.getenv('USERBOT_KEEPALIVE') or 60)
+USERBOT_READY_TIMEOUT = float(os.getenv('USERBOT_READY_TIMEOUT') or 10)
+USERBOT_BACKOFF_MAX = 300
+userbot_ready = asyncio.Event()
+userbot_check = asyncio.Event()
+userbot_lock = asyncio.Lock()
+userbot_supervised = False
+userbot_error = 'Userbot is starting up, try again in a moment.'
+userbot_me = None
+
+async def connect_userbot():
+    global telethon_client, userbot_me
     if not API_ID or not API_HASH:
         raise Exception('Telethon API_ID/API_HASH not configured. Set TELETHON_API_ID and TELETHON_API_HASH in env.')
-    telethon_client = TelegramClient(USERBOT_SESSION, API_ID, API_HASH)
-    await telethon_client.connect()
+    if telethon_client is None:
+        telethon_client = TelegramClient(USERBOT_SESSION, API_ID, API_HASH)
+    if not telethon_client.is_connected():
+        await telethon_client.connect()
     if not await telethon_client.is_user_authorized():
         logging.error('Telethon userbot is not authorized. Please run this script with --create-session to create the session file interactively.')
         raise Exception('Userbot not authorized. Run with --create-session to create session.')
+    userbot_me = await telethon_client.get_me()
+
+async def drop_userbot():
+    global telethon_client
+    if telethon_client is not None:
+        try:
+            await telethon_client.disconnect()
+        except Exception:
+            pass
+        telethon_client = None
+
+async def userbot_supervisor():
+    global userbot_supervised, userbot_error
+    userbot_supervised = True
+    delay = 1
+    while True:
+        try:
+            async with userbot_lock:
+                await connect_userbot()
+            userbot_error = ''
+            userbot_ready.set()
+            delay = 1
+            while True:
+                try:
+                    await asyncio.wait_for(userbot_check.wait(), USERBOT_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    pass
+                userbot_check.clear()
+                if not telethon_client.is_connected():
+                    raise Exception('Userbot connection lost, reconnecting.')
+                await asyncio.wait_for(telethon_client(PingRequest(ping_id=secrets.randbits(63))), USERBOT_READY_TIMEOUT)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            userbot_ready.clear()
+            userbot_error = str(e) or 'Userbot connection lost, reconnecting.'
+            logging.warning('Userbot unavailable (%s); retrying in %ss', userbot_error, delay)
+            async with userbot_lock:
+                await drop_userbot()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, USERBOT_BACKOFF_MAX)
+
+async def ensure_telethon_client():
+    if not userbot_supervised:
+        # CLI paths without the supervisor connect inline (still one client at a time)
+        async with userbot_lock:
+            await connect_userbot()
+        return
+    if userbot_ready.is_set():
+        if telethon_client is not None and telethon_client.is_connected():
+            return
+        # dropped between pings: have the supervisor check now instead of at the next ping
+        userbot_ready.clear()
+        userbot_check.set()
+    try:
+        await asyncio.wait_for(userbot_ready.wait(), USERBOT_READY_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise Exception(userbot_error or 'Userbot is reconnecting, try again in a moment.')
+
+# ---------- USERBOT CALLS ----------
+# A Telethon session can't be shared between processes, so only the owner (the single
+# process, or shard worker 0) runs the userbot. Handlers go through userbot_call: the owner
+# runs the op itself, other shard workers forward it over multiprocessing queues and get
+# the result, or the error text, back. Ops take and return plain picklable values.
+USERBOT_OPS = {
+    'ensure_telethon_client': ensure_telethon_client,
+    'appraise_group': appraise_group,
+    'userbot_is_admin': userbot_is_admin,
+    'leave_group': leave_group,
+    'userbot_name': userbot_name,
+}
+USERBOT_CALL_TIMEOUT = 120
+userbot_rpc = None  # (requests queue, per-shard reply queues), set in shard workers
+userbot_rpc_waiting = {}
+userbot_rpc_ids = iter(range(1, sys.maxsize))
+
+def owns_userbot() -> bool:
+    return SHARD_INDEX in (None, 0)
+
+async def userbot_call(op: str, *args):
+    if owns_userbot() or userbot_rpc is None:
+        return await USERBOT_OPS[op](*args)
+    call_id = next(userbot_rpc_ids)
+    future = asyncio.get_running_loop().create_future()
+    userbot_rpc_waiting[call_id] = future
+    try:
+        userbot_rpc[0].put((SHARD_INDEX, call_id, op, args))
+        ok, result = await asyncio.wait_for(future, USERBOT_CALL_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise Exception('Userbot did not answer in time, try again in a moment.')
+    finally:
+        userbot_rpc_waiting.pop(call_id, None)
+    if not ok:
+        raise Exception(result)
+    return result
+
+def rpc_get(q):
+    # short timeout so the executor thread exits soon after the loop stops
+    try:
+        return q.get(timeout=1)
+    except queue.Empty:
+        return None
+
+async def userbot_rpc_server():
+    requests, replies = userbot_rpc
+    loop = asyncio.get_running_loop()
+    running = set()
+
+    async def serve(shard, call_id, op, args):
+        try:
+            replies[shard].put((call_id, True, await USERBOT_OPS[op](*args)))
+        except Exception as e:
+            replies[shard].put((call_id, False, str(e)))
+
+    while True:
+        request = await loop.run_in_executor(None, rpc_get, requests)
+        if request is not None:
+            task = asyncio.create_task(serve(*request))
+            running.add(task)
+            task.add_done_callback(running.discard)
+
+async def userbot_rpc_replies():
+    replies = userbot_rpc[1][SHARD_INDEX]
+    loop = asyncio.get_running_loop()
+    while True:
+        reply = await loop.run_in_executor(None, rpc_get, replies)
+        if reply is not None:
+            future = userbot_rpc_waiting.get(reply[0])
+            if future is not None and not future.done():
+                future.set_result(reply[1:])
 
 async def create_telethon_session_interactive():
     if not API_ID or not API_HASH:
@@ -1024,6 +2170,836 @@ async def create_telethon_session_interactive():
         print('Failed to authorize session')
     await client.disconnect()
 
+# ---------- BACKUP & MAINTENANCE ----------
+# These jobs use their own connection in a worker thread so the event loop never waits on them.
+BACKUP_DIR = os.getenv('BACKUP_DIR') or 'backups'
+BACKUP_INTERVAL_HOURS = float(os.getenv('BACKUP_INTERVAL_HOURS') or 24)
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP') or 7)
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_SLEEP = 0.02
+MAINTENANCE_INTERVAL_HOURS = float(os.getenv('MAINTENANCE_INTERVAL_HOURS') or 6)
+INCREMENTAL_VACUUM_PAGES = 2000
+ARCHIVE_INTERVAL_HOURS = float(os.getenv('ARCHIVE_INTERVAL_HOURS') or 24)
+ARCHIVE_BATCH = 500
+ARCHIVE_BATCH_SLEEP = 0.05
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def backup_database(db_path=DB_PATH, backup_dir=BACKUP_DIR):
+    os.makedirs(backup_dir, exist_ok=True)
+    base = os.path.splitext(os.path.basename(db_path))[0]
+    target = os.path.join(backup_dir, f"{base}-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.db")
+    partial = target + '.part'
+    src = sqlite3.connect(db_path, timeout=30)
+    dst = sqlite3.connect(partial)
+    try:
+        # An open read transaction pins a WAL snapshot: writers carry on, and the
+        # backup never restarts because of their commits between steps.
+        src.execute('BEGIN')
+        src.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+        src.backup(dst, pages=BACKUP_PAGES_PER_STEP, progress=lambda status, remaining, total: time.sleep(BACKUP_STEP_SLEEP))
+        src.rollback()
+        check = dst.execute('PRAGMA quick_check').fetchone()[0]
+    finally:
+        dst.close()
+        src.close()
+    if check != 'ok':
+        os.remove(partial)
+        raise RuntimeError(f'backup failed quick_check: {check}')
+    os.replace(partial, target)
+    with open(target + '.sha256', 'w') as f:
+        f.write(f'{file_sha256(target)}  {os.path.basename(target)}\n')
+    snapshots = sorted(n for n in os.listdir(backup_dir) if n.startswith(base + '-') and n.endswith('.db'))
+    for name in snapshots[:-BACKUP_KEEP]:
+        for path in (os.path.join(backup_dir, name), os.path.join(backup_dir, name + '.sha256')):
+            if os.path.exists(path):
+                os.remove(path)
+    return target
+
+def maintain_database(db_path=DB_PATH):
+    db = sqlite3.connect(db_path, timeout=30)
+    try:
+        db.execute('ANALYZE')
+        # only a DB in incremental mode can hand pages back; others need --enable-incremental-vacuum
+        if db.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+            db.execute(f'PRAGMA incremental_vacuum({INCREMENTAL_VACUUM_PAGES})').fetchall()
+        db.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchall()
+        return db.execute('PRAGMA integrity_check').fetchone()[0]
+    finally:
+        db.close()
+
+def enable_incremental_vacuum(db_path=DB_PATH):
+    # The switch needs one full VACUUM, which rewrites the file under the write lock:
+    # run it with the bot stopped, not from the maintenance loop.
+    db = sqlite3.connect(db_path, timeout=30)
+    try:
+        if db.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+            return False
+        db.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        db.execute('VACUUM')
+        return True
+    finally:
+        db.close()
+
+def archive_settled_rows(db_path=DB_PATH, archive_path=ARCHIVE_DB_PATH, days=ARCHIVE_AFTER_DAYS):
+    # Moves rows in ARCHIVE_BATCH-sized transactions so writers are never held up for long.
+    # A WAL commit spanning two files is only atomic per file: a crash can leave a batch
+    # in both, which the DELETE at the start of the next run cleans up.
+    cutoff = (datetime.utcnow() - timedelta(days=days)).isoformat()
+    db = sqlite3.connect(db_path, timeout=30)
+    db.execute('ATTACH DATABASE ? AS archive', (archive_path,))
+    moved = {}
+    try:
+        for table, (where, _) in ARCHIVED_TABLES.items():
+            cols = ', '.join(r[1] for r in db.execute(f'PRAGMA main.table_info({table})').fetchall())
+            db.execute(f'DELETE FROM main.{table} WHERE id IN (SELECT id FROM archive.{table})')
+            db.commit()
+            moved[table] = 0
+            while True:
+                ids = [r[0] for r in db.execute(f'SELECT id FROM main.{table} WHERE {where} ORDER BY id LIMIT ?', (cutoff, ARCHIVE_BATCH))]
+                if not ids:
+                    break
+                marks = ','.join('?' * len(ids))
+                db.execute('BEGIN IMMEDIATE')
+                db.execute(f'INSERT OR IGNORE INTO archive.{table}({cols}) SELECT {cols} FROM main.{table} WHERE id IN ({marks})', ids)
+                db.execute(f'DELETE FROM main.{table} WHERE id IN ({marks})', ids)
+                db.commit()
+                moved[table] += len(ids)
+                time.sleep(ARCHIVE_BATCH_SLEEP)
+    finally:
+        db.close()
+    return moved
+
+async def archive_loop():
+    while True:
+        try:
+            moved = await asyncio.to_thread(archive_settled_rows)
+            if any(moved.values()):
+                logging.info('Archived %s', ', '.join(f'{n} {t}' for t, n in moved.items()))
+        except Exception as e:
+            logging.exception('Archiving failed')
+            for aid in ADMIN_IDS:
+                enqueue_message(aid, f'⚠️ Archiving failed: {e}')
+            conn.commit()
+        await asyncio.sleep(ARCHIVE_INTERVAL_HOURS * 3600)
+
+async def backup_loop():
+    while True:
+        try:
+            path = await asyncio.to_thread(backup_database)
+            logging.info('Database backup written to %s', path)
+            path = await asyncio.to_thread(backup_database, ARCHIVE_DB_PATH)
+            logging.info('Archive backup written to %s', path)
+        except Exception as e:
+            logging.exception('Database backup failed')
+            for aid in ADMIN_IDS:
+                enqueue_message(aid, f'⚠️ Database backup failed: {e}')
+            conn.commit()
+        await asyncio.sleep(BACKUP_INTERVAL_HOURS * 3600)
+
+async def maintenance_loop():
+    while True:
+        await asyncio.sleep(MAINTENANCE_INTERVAL_HOURS * 3600)
+        try:
+            result = await asyncio.to_thread(maintain_database)
+            if result == 'ok':
+                result = await asyncio.to_thread(maintain_database, ARCHIVE_DB_PATH)
+        except Exception as e:
+            result = str(e)
+        if result != 'ok':
+            logging.error('Database maintenance reported: %s', result)
+            for aid in ADMIN_IDS:
+                enqueue_message(aid, f'⚠️ Database integrity check: {result[:500]}')
+            conn.commit()
+
+def bench_backup(rows=200000, seconds=3.0):
+    # Insert+commit latency on a scratch DB, idle vs. while backup_database runs.
+    scratch = tempfile.mkdtemp(prefix='backup_bench_')
+    path = os.path.join(scratch, 'bench.db')
+    db = sqlite3.connect(path, timeout=30)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('CREATE TABLE sold_groups (id INTEGER PRIMARY KEY, user_id INTEGER, group_title TEXT, sold_at TEXT)')
+    db.executemany('INSERT INTO sold_groups(user_id,group_title,sold_at) VALUES(?,?,?)',
+                   ((i % 5000, f'group {i}' * 4, datetime.utcnow().isoformat()) for i in range(rows)))
+    db.commit()
+
+    def measure(until):
+        lat = []
+        while not until():
+            t = time.perf_counter()
+            db.execute('INSERT INTO sold_groups(user_id,group_title,sold_at) VALUES(?,?,?)', (1, 'bench', datetime.utcnow().isoformat()))
+            db.commit()
+            lat.append(time.perf_counter() - t)
+            time.sleep(0.001)
+        lat.sort()
+        return lat
+
+    def report(label, lat):
+        print(f'{label}: {len(lat)} writes, p50={lat[len(lat) // 2] * 1000:.2f}ms '
+              f'p99={lat[int(len(lat) * 0.99)] * 1000:.2f}ms max={lat[-1] * 1000:.2f}ms')
+
+    end = time.monotonic() + seconds
+    report('idle', measure(lambda: time.monotonic() > end))
+    worker = threading.Thread(target=backup_database, args=(path, os.path.join(scratch, 'backups')))
+    started = time.perf_counter()
+    worker.start()
+    report('during backup', measure(lambda: not worker.is_alive()))
+    print(f'backup of {os.path.getsize(path) / 1e6:.1f} MB took {time.perf_counter() - started:.2f}s')
+
+# ---------- PROFILER ----------
+# /profile [seconds] samples the event-loop thread from a helper thread. Output, in
+# PROFILE_DIR: <base>.folded (collapsed stacks for flamegraph.pl / speedscope),
+# <base>.tasks.txt (asyncio task dumps once a second) and <base>.blocking.txt (every
+# stretch where the loop heartbeat stalled longer than PROFILE_BLOCK_THRESHOLD, with
+# the handler and line that held it). Nothing runs while the profiler is off.
+PROFILE_DIR = os.getenv('PROFILE_DIR') or 'profiles'
+PROFILE_INTERVAL = 0.005
+PROFILE_BLOCK_THRESHOLD = float(os.getenv('PROFILE_BLOCK_THRESHOLD') or 0.1)
+PROFILE_MAX_SECONDS = 300
+profile_running = False
+
+def frame_stack(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append((code.co_name, os.path.basename(code.co_filename), code.co_firstlineno, frame.f_lineno))
+        frame = frame.f_back
+    return stack[::-1]
+
+# coroutines that run a handler's body in their own task (transfer_single_flight), so the
+# registered handler is never on the sampled stack
+PROFILE_HANDLER_BODIES = {'confirm_transfer', 'verify_transfer'}
+
+def handler_names():
+    names = {h.handler.__name__ for obs in (dp.message_handlers, dp.callback_query_handlers) for h in obs.handlers}
+    return names | PROFILE_HANDLER_BODIES
+
+def sample_loop_thread(thread_id, until, state, result):
+    folded = {}
+    blocks = []
+    block = None
+    while time.monotonic() < until:
+        frame = sys._current_frames().get(thread_id)
+        stack = frame_stack(frame) if frame is not None else []
+        key = ';'.join(f'{name} ({file}:{first})' for name, file, first, _ in stack)
+        folded[key] = folded.get(key, 0) + 1
+        now = time.monotonic()
+        if now - state['beat'] > PROFILE_BLOCK_THRESHOLD:
+            if block is None:
+                block = {'start': state['beat'], 'stack': stack}
+        elif block is not None:
+            block['duration'] = now - block['start']
+            blocks.append(block)
+            block = None
+        time.sleep(PROFILE_INTERVAL)
+    result['folded'] = folded
+    result['blocks'] = blocks
+
+def dump_tasks(f):
+    f.write(f'--- {datetime.utcnow().isoformat()} ---\n')
+    for task in asyncio.all_tasks():
+        f.write(f'{task.get_name()}: {getattr(task.get_coro(), "__qualname__", task.get_coro())}\n')
+        for frame in task.get_stack(limit=8):
+            f.write(f'    {frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})\n')
+
+async def run_profiler(seconds: float):
+    global profile_running
+    base = os.path.join(PROFILE_DIR, f"profile-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}")
+    state = {'beat': time.monotonic()}
+    result = {}
+    profile_running = True
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        sampler = threading.Thread(target=sample_loop_thread, daemon=True,
+                                   args=(threading.get_ident(), time.monotonic() + seconds, state, result))
+        sampler.start()
+        next_dump = 0.0
+        with open(base + '.tasks.txt', 'w') as dump:
+            while sampler.is_alive():
+                state['beat'] = time.monotonic()
+                if state['beat'] >= next_dump:
+                    dump_tasks(dump)
+                    next_dump = state['beat'] + 1
+                await asyncio.sleep(0.01)
+    finally:
+        profile_running = False
+
+    with open(base + '.folded', 'w') as f:
+        for key, count in sorted(result['folded'].items()):
+            f.write(f'{key} {count}\n')
+    names = handler_names()
+    offenders = {}
+    with open(base + '.blocking.txt', 'w') as f:
+        for b in result['blocks']:
+            handler = next((frame[0] for frame in reversed(b['stack']) if frame[0] in names), '<event loop>')
+            leaf = b['stack'][-1] if b['stack'] else ('?', '?', 0, 0)
+            where = f'{leaf[0]} ({leaf[1]}:{leaf[3]})'
+            f.write(f"{b['duration'] * 1000:.0f}ms blocked in {handler} at {where}\n")
+            f.write(''.join(f'    {n} ({fl}:{ln})\n' for n, fl, _, ln in b['stack']))
+            worst = offenders.get(handler, (0, 0.0, where))
+            offenders[handler] = (worst[0] + 1, max(worst[1], b['duration']), where if b['duration'] >= worst[1] else worst[2])
+    samples = sum(result['folded'].values())
+    text = f'🩺 Profile: {seconds:.0f}s, {samples} samples\n{base}.folded\n'
+    if offenders:
+        text += f'\nLoop blocked > {PROFILE_BLOCK_THRESHOLD * 1000:.0f}ms:\n'
+        for handler, (count, worst, where) in sorted(offenders.items(), key=lambda kv: -kv[1][1]):
+            text += f'• {handler}: {count}x, worst {worst * 1000:.0f}ms at {where}\n'
+    else:
+        text += '\nNo loop stalls above threshold.'
+    return text
+
+async def profile_and_report(admin_id: int, seconds: float):
+    try:
+        text = await run_profiler(seconds)
+    except Exception as e:
+        logging.exception('Profiler failed')
+        text = f'Profiler failed: {e}'
+    enqueue_message(admin_id, text)
+    conn.commit()
+
+# ---------- LIFECYCLE ----------
+background_tasks = []
+SHARD_INDEX = None
+
+async def on_startup(dispatcher):
+    background_tasks.append(asyncio.create_task(new_users_flusher()))
+    if owns_userbot() and API_ID and API_HASH:
+        background_tasks.append(asyncio.create_task(userbot_supervisor()))
+    if userbot_rpc is not None:
+        background_tasks.append(asyncio.create_task(userbot_rpc_server() if owns_userbot() else userbot_rpc_replies()))
+    # bot-wide jobs run once: in the single process, or only in shard worker 0
+    if SHARD_INDEX in (None, 0):
+        background_tasks.append(asyncio.create_task(support_digest_loop()))
+        background_tasks.append(asyncio.create_task(outbox_dispatcher()))
+        background_tasks.append(asyncio.create_task(backup_loop()))
+        background_tasks.append(asyncio.create_task(maintenance_loop()))
+        if ARCHIVE_AFTER_DAYS > 0:
+            background_tasks.append(asyncio.create_task(archive_loop()))
+
+async def on_shutdown(dispatcher):
+    for task in background_tasks:
+        task.cancel()
+    flush_new_users()
+    await drop_userbot()
+
+# ---------- UPDATE CAPTURE & REPLAY ----------
+# Capture: CAPTURE_UPDATES=updates.jsonl writes every incoming update with ids hashed
+# (salted, stable within a capture) and names, media and secrets removed.
+# Replay: --replay updates.jsonl [--speed 1|10|max] feeds them to dp.process_update
+# against a scratch DB and a local fake Bot API, then prints per-handler latency.
+CAPTURE_ID_OWNERS = {'from', 'chat', 'user', 'sender_chat', 'forward_from', 'forward_from_chat',
+                     'new_chat_member', 'old_chat_member', 'via_bot'}
+CAPTURE_NAME_KEYS = {'first_name', 'last_name', 'username', 'title', 'invite_link'}
+CAPTURE_DROP_KEYS = {'contact', 'location', 'venue', 'photo', 'document', 'video', 'voice', 'audio', 'sticker',
+                     'animation', 'video_note', 'entities', 'caption_entities', 'reply_markup', 'bio'}
+# messages the bot wrote (e.g. the admin withdrawal alert under a callback) carry other users' data
+CAPTURE_BOT_MESSAGE_KEYS = {('callback_query', 'message'), ('message', 'reply_to_message'), ('message', 'pinned_message')}
+CAPTURE_SCRUBBERS = (
+    (re.compile(r'\d{6,}:[A-Za-z0-9_-]{30,}'), lambda m: '<token>'),
+    (re.compile(r'(t\.me/\+|t\.me/joinchat/|telegram\.me/joinchat/)([A-Za-z0-9_-]+)'),
+     lambda m: m.group(1) + hashlib.sha256((CAPTURE_SALT + m.group(2)).encode()).hexdigest()[:16]),
+    (re.compile(r'0x[0-9a-fA-F]{40}'), lambda m: '<wallet>'),
+    (re.compile(r'[\w.-]+@[\w.-]+'), lambda m: 'user@upi'),
+    (re.compile(r'\+\d[\d -]{8,}\d|\d{2,}[ -]\d[\d -]{3,}\d'), lambda m: '<number>'),
+    # any other long digit run may be a user id: hash it like `id` fields so lookups still line up
+    (re.compile(r'\d{6,}'), lambda m: str(capture_hash_id(int(m.group())))),
+)
+
+def capture_hash_id(value):
+    if not isinstance(value, int):
+        return value
+    h = int(hashlib.sha256(f'{CAPTURE_SALT}:{abs(value)}'.encode()).hexdigest()[:12], 16)
+    return -h if value < 0 else h
+
+def scrub_text(text):
+    for pattern, repl in CAPTURE_SCRUBBERS:
+        text = pattern.sub(repl, text)
+    return text
+
+def redact_update(obj, owner=None):
+    if isinstance(obj, list):
+        return [redact_update(v, owner) for v in obj]
+    if not isinstance(obj, dict):
+        return obj
+    out = {}
+    for k, v in obj.items():
+        if k in CAPTURE_DROP_KEYS:
+            continue
+        if k in CAPTURE_NAME_KEYS:
+            out[k] = 'redacted'
+        elif k == 'id' and owner in CAPTURE_ID_OWNERS:
+            out[k] = capture_hash_id(v)
+        elif k in ('text', 'caption') and isinstance(v, str):
+            out[k] = scrub_text(v)
+        elif k == 'data' and isinstance(v, str):
+            # callback payloads such as admin_user_add:<user id>
+            out[k] = re.sub(r'\d{6,}', lambda m: str(capture_hash_id(int(m.group()))), v)
+        elif (owner, k) in CAPTURE_BOT_MESSAGE_KEYS and isinstance(v, dict):
+            out[k] = {mk: mv for mk, mv in redact_update(v, k).items() if mk not in ('text', 'caption')}
+        else:
+            out[k] = redact_update(v, k)
+    return out
+
+class CaptureMiddleware(BaseMiddleware):
+    """Appends each incoming update, redacted, to a JSONL file."""
+
+    def __init__(self, path):
+        super().__init__()
+        self.file = open(path, 'a', encoding='utf-8')
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        raw = update.to_python()
+        line = redact_update(raw)
+        line['_ts'] = time.time()
+        if update_route_id(raw) in ADMIN_IDS:
+            line['_admin'] = True
+        self.file.write(json.dumps(line, ensure_ascii=False) + '\n')
+        self.file.flush()
+
+if CAPTURE_UPDATES:
+    dp.middleware.setup(CaptureMiddleware(CAPTURE_UPDATES))
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """Records wall time per matched handler (name -> list of seconds)."""
+
+    def __init__(self):
+        super().__init__()
+        self.timings = {}
+
+    def _start(self, data):
+        data['_timing'] = (current_handler.get().__name__, time.perf_counter())
+
+    def _stop(self, data):
+        name, started = data.pop('_timing', ('<no handler>', None))
+        self.timings.setdefault(name, []).append(time.perf_counter() - started if started else 0.0)
+
+    async def on_process_message(self, message, data):
+        self._start(data)
+
+    async def on_post_process_message(self, message, results, data):
+        self._stop(data)
+
+    async def on_process_callback_query(self, query, data):
+        self._start(data)
+
+    async def on_post_process_callback_query(self, query, results, data):
+        self._stop(data)
+
+async def start_fake_bot_api(latency=0.0):
+    # Minimal stand-in for the Bot API that answers well-formed results for the
+    # methods this bot uses. Returns (runner, server, per-method call counts).
+    from aiohttp import web
+    calls = {}
+    next_id = [1]
+
+    async def handle(request):
+        method = request.match_info['method']
+        calls[method] = calls.get(method, 0) + 1
+        form = await request.post()
+        if latency:
+            await asyncio.sleep(latency)
+        chat_id = form.get('chat_id') or '0'
+        chat_id = int(chat_id) if chat_id.lstrip('-').isdigit() else chat_id
+        if method in ('sendMessage', 'editMessageText', 'editMessageReplyMarkup'):
+            next_id[0] += 1
+            result = {'message_id': int(form.get('message_id') or next_id[0]), 'date': int(time.time()),
+                      'chat': {'id': chat_id, 'type': 'private'}, 'text': form.get('text', '')}
+        elif method == 'getChatMember':
+            result = {'user': {'id': int(form.get('user_id') or 0), 'is_bot': False, 'first_name': 'user'}, 'status': 'member'}
+        elif method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'bot', 'username': 'replay_bot'}
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    return runner, TelegramAPIServer.from_base(f'http://127.0.0.1:{runner.addresses[0][1]}'), calls
+
+async def replay_updates(path, speed='1'):
+    with open(path, encoding='utf-8') as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+    if not updates:
+        print('No updates in', path)
+        return
+    for u in updates:
+        if u.pop('_admin', False):
+            ADMIN_IDS.append(update_route_id(u))
+    runner, server, calls = await start_fake_bot_api()
+    bot.server = server
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    timing = HandlerTimingMiddleware()
+    dp.middleware.setup(timing)
+    factor = None if speed == 'max' else float(speed)
+    first_ts = updates[0].get('_ts', 0.0)
+    started = time.monotonic()
+    tasks = []
+    chains = {}
+
+    async def run_in_order(prev, u):
+        # one user's updates run one after another (as in a shard worker), users concurrently
+        if prev is not None:
+            await asyncio.wait([prev])
+        return await dp.process_update(types.Update.to_object(u))
+
+    for u in updates:
+        ts = u.pop('_ts', first_ts)
+        if factor:
+            delay = (ts - first_ts) / factor - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        uid = update_route_id(u)
+        chains[uid] = asyncio.create_task(run_in_order(chains.get(uid), u))
+        tasks.append(chains[uid])
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    elapsed = time.monotonic() - started
+    flush_new_users()
+    errors_seen = sum(1 for r in results if isinstance(r, Exception))
+    pace = 'max speed' if speed == 'max' else f'{speed}x'
+    print(f'Replayed {len(updates)} updates at {pace} in {elapsed:.2f}s ({errors_seen} raised), DB: {DB_PATH}')
+    print(f"{'handler':32} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}")
+    for name, lat in sorted(timing.timings.items(), key=lambda kv: -sum(kv[1])):
+        lat.sort()
+        print(f'{name:32} {len(lat):6} {lat[len(lat) // 2] * 1000:9.2f} {lat[int(len(lat) * 0.95)] * 1000:9.2f} {lat[-1] * 1000:9.2f}')
+    print('Bot API calls:', ', '.join(f'{m}={n}' for m, n in sorted(calls.items())))
+    await (await bot.get_session()).close()
+    await runner.cleanup()
+
+async def stress_transfers(transfers=50, taps=10):
+    # Fires concurrent Verify/Confirm/Cancel taps at multi-item transfers through the
+    # dispatcher (fake Bot API, simulated userbot) and checks nothing is credited twice.
+    import random
+    checks = []
+
+    async def userbot_up():
+        pass
+
+    async def slow_admin_check(link):
+        checks.append(link)
+        await asyncio.sleep(0.05)
+        return not link.endswith('/pending')
+
+    async def stress_userbot_name():
+        return 'userbot'
+
+    USERBOT_OPS.update(ensure_telethon_client=userbot_up, userbot_is_admin=slow_admin_check, userbot_name=stress_userbot_name)
+    runner, server, calls = await start_fake_bot_api()
+    bot.server = server
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+
+    expected = {}
+    for n in range(transfers):
+        uid = 100000 + n
+        ensure_user(uid)
+        items = [dict(link=f'https://t.me/stress{n}_{i}', title=f'G{n}.{i}', year_label='Jan 2023', messages_count=10,
+                      tier='Default', price_inr=100.0, price_usd=1.0) for i in range(3)]
+        # every fifth transfer keeps one group untransferred so partial credit is exercised
+        if n % 5 == 0:
+            items[-1]['link'] = f'https://t.me/stress{n}/pending'
+        key = make_transfer_key(uid, str(n))
+        store_pending_transfer(key, uid, items)
+        expected[uid] = key
+    flush_new_users()
+
+    updates = []
+    for uid, key in expected.items():
+        actions = ['verify_transfer'] * taps + ['confirm_sell'] * 2 + (['cancel_sell'] if uid % 7 == 0 else [])
+        for action in actions:
+            updates.append({'update_id': len(updates) + 1, 'callback_query': {
+                'id': str(len(updates) + 1), 'chat_instance': 'stress', 'data': f'{action}:{key}',
+                'from': {'id': uid, 'is_bot': False, 'first_name': 'seller'},
+                'message': {'message_id': 1, 'date': int(time.time()), 'chat': {'id': uid, 'type': 'private'}, 'text': 'quote'}}})
+    random.shuffle(updates)
+    started = time.monotonic()
+    results = await asyncio.gather(*(dp.process_update(types.Update.to_object(u)) for u in updates), return_exceptions=True)
+    elapsed = time.monotonic() - started
+
+    problems = 0
+    for uid, key in expected.items():
+        cur.execute('SELECT COUNT(*), COUNT(DISTINCT group_link), COALESCE(SUM(price_inr), 0) FROM sold_groups WHERE user_id=?', (uid,))
+        sold, distinct, total = cur.fetchone()
+        cur.execute('SELECT balance_inr FROM users WHERE user_id=?', (uid,))
+        balance = cur.fetchone()[0]
+        cur.execute('SELECT COUNT(*) FROM transfer_items WHERE transfer_key=? AND sold=1', (key,))
+        if sold != distinct or balance != total or cur.fetchone()[0] != sold or transfer_status(key) == 'verifying':
+            problems += 1
+    raised = sum(1 for r in results if isinstance(r, Exception))
+    print(f'{len(updates)} taps on {transfers} transfers in {elapsed:.2f}s ({raised} raised)')
+    print(f'ownership checks: {len(checks)} (one pass would be {transfers * 3})')
+    cur.execute("SELECT status, COUNT(*) FROM transfers GROUP BY status")
+    print('transfer states:', ', '.join(f'{st}={c}' for st, c in cur.fetchall()))
+    print('double credits / inconsistent transfers:', problems, '-> OK' if problems == 0 else '-> FAILED')
+    await (await bot.get_session()).close()
+    await runner.cleanup()
+    return problems
+
+# ---------- SHARDED WORKERS ----------
+# One ingress process long-polls Telegram and routes each update by user id to a
+# fixed worker process. A user always lands on the same worker (and the same
+# MemoryStorage), and each worker handles a given user's updates strictly in order.
+UPDATE_USER_FIELDS = ('message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+                      'shipping_query', 'pre_checkout_query', 'my_chat_member', 'chat_member', 'chat_join_request')
+
+def update_route_id(data: dict) -> int:
+    for field in UPDATE_USER_FIELDS:
+        obj = data.get(field)
+        if obj and obj.get('from'):
+            return obj['from']['id']
+    if data.get('poll_answer'):
+        return data['poll_answer']['user']['id']
+    for field in ('channel_post', 'edited_channel_post'):
+        obj = data.get(field)
+        if obj:
+            return obj['chat']['id']
+    return 0
+
+def shard_for(data: dict, workers: int) -> int:
+    return update_route_id(data) % workers
+
+def run_shard_worker(index: int, inbox, done=None, background=True, rpc=None):
+    # the parent drives shutdown (None on the inbox), so Ctrl-C or a SIGTERM sent to the
+    # whole process group doesn't kill a worker before on_shutdown has run
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(_shard_worker_loop(index, inbox, done, background, rpc))
+
+async def _shard_worker_loop(index: int, inbox, done, background=True, rpc=None):
+    global SHARD_INDEX, userbot_rpc
+    SHARD_INDEX = index
+    userbot_rpc = rpc
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    loop = asyncio.get_running_loop()
+    chains = {}
+    processed = 0
+
+    async def run_in_order(prev, data):
+        nonlocal processed
+        if prev is not None:
+            await prev
+        try:
+            await dp.process_update(types.Update.to_object(data))
+        except Exception:
+            logging.exception('Shard %s failed to process update %s', index, data.get('update_id'))
+        processed += 1
+
+    def forget(uid, task):
+        if chains.get(uid) is task:
+            del chains[uid]
+
+    if background:
+        await on_startup(dp)
+    if done is not None:
+        done.put(('ready', index))
+    parent = multiprocessing.parent_process()
+    while True:
+        try:
+            batch = await loop.run_in_executor(None, inbox.get, True, 1)
+        except queue.Empty:
+            # an ingress killed outright never sends None
+            if parent is not None and not parent.is_alive():
+                break
+            continue
+        if batch is None:
+            break
+        for data in batch:
+            uid = update_route_id(data)
+            task = asyncio.create_task(run_in_order(chains.get(uid), data))
+            chains[uid] = task
+            task.add_done_callback(lambda t, uid=uid: forget(uid, t))
+    if chains:
+        await asyncio.wait(list(chains.values()))
+    await on_shutdown(dp)
+    if done is not None:
+        done.put(('done', processed))
+    await (await bot.get_session()).close()
+
+def route_batch(inboxes, updates):
+    # one queue item per shard per batch keeps IPC cost per update low
+    batches = [[] for _ in inboxes]
+    for data in updates:
+        batches[shard_for(data, len(inboxes))].append(data)
+    for q, batch in zip(inboxes, batches):
+        if batch:
+            q.put(batch)
+
+shard_rpc = None
+SHARD_MIN_UPTIME = 60  # a worker dying sooner than this after a (re)start stops the ingress
+
+def start_shard_workers(workers: int, done=None, background=True):
+    ctx = multiprocessing.get_context('spawn')
+    inboxes = [ctx.Queue() for _ in range(workers)]
+    # userbot calls from workers 1..N-1 to worker 0, and one reply queue per worker
+    # kept in a global: Process.start() drops its args, and a queue collected before the
+    # child unpickles it takes its semaphore with it
+    global shard_rpc
+    shard_rpc = (ctx.Queue(), [ctx.Queue() for _ in range(workers)])
+    procs = [ctx.Process(target=run_shard_worker, args=(i, inboxes[i], done, background, shard_rpc), daemon=True) for i in range(workers)]
+    for p in procs:
+        p.start()
+        p.started_at = time.monotonic()
+    return inboxes, procs
+
+def stop_shard_workers(inboxes, procs):
+    for q in inboxes:
+        q.put(None)
+    for p in procs:
+        p.join(timeout=30)
+        if p.is_alive():
+            # workers ignore SIGTERM, so terminate() wouldn't do
+            logging.warning('Shard worker pid %s did not stop in time, killing it', p.pid)
+            p.kill()
+            p.join()
+
+def check_shard_workers(inboxes, procs):
+    # A dead worker would leave its users' updates piling up in an inbox nobody reads.
+    # One killed mid-read can also leave a queue's lock held (its inbox, or the userbot
+    # queues), so restart the whole pool on fresh queues; the live workers drain their
+    # inboxes first. Dying right after a start means the bot itself is broken (e.g.
+    # on_startup raising), so give up rather than loop.
+    dead = [(i, p) for i, p in enumerate(procs) if not p.is_alive()]
+    if not dead:
+        return
+    for i, p in dead:
+        logging.error('Shard worker %s (pid %s) exited with code %s', i, p.pid, p.exitcode)
+        # its unread batches are lost; don't let them block this process's exit either
+        inboxes[i].cancel_join_thread()
+    if any(time.monotonic() - p.started_at < SHARD_MIN_UPTIME for _, p in dead):
+        raise RuntimeError(f'shard worker {dead[0][0]} exited right after starting, stopping')
+    stop_shard_workers(inboxes, procs)
+    inboxes[:], procs[:] = start_shard_workers(len(procs))
+    logging.warning('Restarted %d shard workers', len(procs))
+
+async def _shard_ingress_loop(inboxes, procs):
+    await dp.skip_updates()
+    offset = None
+    while True:
+        check_shard_workers(inboxes, procs)
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=20)
+        except Exception:
+            logging.exception('getUpdates failed')
+            await asyncio.sleep(1)
+            continue
+        if updates:
+            route_batch(inboxes, [u.to_python() for u in updates])
+            offset = updates[-1].update_id + 1
+
+def run_sharded(workers: int):
+    # SIGTERM (systemd, docker stop) ends the ingress like Ctrl-C, so workers get a clean shutdown
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    inboxes, procs = start_shard_workers(workers)
+    print(f'Sharded ingress started with {workers} workers.')
+    try:
+        asyncio.run(_shard_ingress_loop(inboxes, procs))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_shard_workers(inboxes, procs)
+
+def serve_fake_bot_api():
+    # start_fake_bot_api on its own loop in a daemon thread, so worker processes can reach it
+    started = threading.Event()
+    port = []
+
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        runner, _, _ = loop.run_until_complete(start_fake_bot_api())
+        port.append(runner.addresses[0][1])
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+    return f'http://127.0.0.1:{port[0]}'
+
+def bench_shards(max_workers: int, updates=20000, users=500):
+    # Each synthetic user opens Support and sends a question: two full dispatches, one
+    # INSERT+commit into the shared scratch DB and two replies to a local fake Bot API.
+    # Workers run without background jobs (no backups, outbox, archive or userbot).
+    ctx = multiprocessing.get_context('spawn')
+    os.environ['BOT_API_SERVER'] = serve_fake_bot_api()
+    synthetic = []
+    for i in range(updates):
+        uid = 1000 + (i // 2) % users
+        text = '🧑‍💻 Support' if i % 2 == 0 else f'bench question {i}'
+        synthetic.append({'update_id': i + 1, 'message': {'message_id': i + 1, 'date': int(time.time()), 'text': text,
+                                                          'from': {'id': uid, 'is_bot': False, 'first_name': 'bench'},
+                                                          'chat': {'id': uid, 'type': 'private'}}})
+    for n in range(1, max_workers + 1):
+        done = ctx.Queue()
+        inboxes, procs = start_shard_workers(n, done, background=False)
+        for _ in range(n):
+            done.get()
+        cur.execute('SELECT COUNT(*) FROM supports')
+        tickets_before = cur.fetchone()[0]
+        started = time.perf_counter()
+        for i in range(0, len(synthetic), 100):
+            route_batch(inboxes, synthetic[i:i + 100])
+        for q in inboxes:
+            q.put(None)
+        processed = sum(done.get()[1] for _ in range(n))
+        elapsed = time.perf_counter() - started
+        for p in procs:
+            p.join(timeout=30)
+        cur.execute('SELECT COUNT(*) FROM supports')
+        written = cur.fetchone()[0] - tickets_before
+        print(f'{n} worker(s): {processed} updates ({written} DB writes) in {elapsed:.2f}s -> {processed / elapsed:.0f} updates/s')
+    print('Scratch DB:', DB_PATH)
+
+def bench_transport(requests=5000, concurrency=50):
+    # Local stand-in for the Bot API: answers every method with ok/True and counts
+    # the distinct client sockets it sees (connection churn).
+    from aiohttp import web
+
+    async def run():
+        peers = set()
+
+        async def handle(request):
+            peers.add(request.transport.get_extra_info('peername'))
+            return web.json_response({'ok': True, 'result': True})
+
+        app = web.Application()
+        app.router.add_post('/{tail:.*}', handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        server = TelegramAPIServer.from_base(f'http://127.0.0.1:{runner.addresses[0][1]}')
+        clients = (
+            ('no keep-alive', PooledBot(token=BOT_TOKEN, server=server, keepalive_timeout=0)),
+            ('aiogram default', Bot(token=BOT_TOKEN, server=server)),
+            ('pooled', PooledBot(token=BOT_TOKEN, server=server, connections_limit=BOT_API_POOL_SIZE)),
+        )
+        for label, client in clients:
+            peers.clear()
+            sem = asyncio.Semaphore(concurrency)
+
+            async def one():
+                async with sem:
+                    await client.send_chat_action(1, 'typing')
+
+            started = time.perf_counter()
+            await asyncio.gather(*(one() for _ in range(requests)))
+            elapsed = time.perf_counter() - started
+            print(f'{label}: {requests / elapsed:.0f} req/s, {len(peers)} connections for {requests} requests')
+            await (await client.get_session()).close()
+        await runner.cleanup()
+
+    asyncio.run(run())
+
 # ---------- DEBUG ----------
 @dp.message_handler(commands=['whoami'])
 async def whoami(m: types.Message):
@@ -1034,6 +3010,46 @@ if __name__ == '__main__':
     if '--create-session' in sys.argv:
         asyncio.run(create_telethon_session_interactive())
         sys.exit(0)
+    if '--stress-transfers' in sys.argv:
+        idx = sys.argv.index('--stress-transfers')
+        count = int(sys.argv[idx + 1]) if len(sys.argv) > idx + 1 and sys.argv[idx + 1].isdigit() else 50
+        sys.exit(1 if asyncio.run(stress_transfers(count)) else 0)
+    if '--replay' in sys.argv:
+        replay_path = sys.argv[sys.argv.index('--replay') + 1]
+        replay_speed = sys.argv[sys.argv.index('--speed') + 1] if '--speed' in sys.argv else '1'
+        asyncio.run(replay_updates(replay_path, replay_speed))
+        sys.exit(0)
+    if '--rebuild-rollups' in sys.argv:
+        rebuild_rollups()
+        print('Rollups rebuilt.')
+        sys.exit(0)
+    if '--bench-search' in sys.argv:
+        bench_search()
+        sys.exit(0)
+    if '--backup' in sys.argv:
+        print('Backup written to', backup_database())
+        print('Archive backup written to', backup_database(ARCHIVE_DB_PATH))
+        sys.exit(0)
+    if '--enable-incremental-vacuum' in sys.argv:
+        for path in (DB_PATH, ARCHIVE_DB_PATH):
+            print(path, 'switched to incremental auto-vacuum' if enable_incremental_vacuum(path) else 'already uses incremental auto-vacuum')
+        sys.exit(0)
+    if '--archive' in sys.argv:
+        if ARCHIVE_AFTER_DAYS <= 0:
+            print('Archiving is disabled (ARCHIVE_AFTER_DAYS=0)')
+            sys.exit(0)
+        moved = archive_settled_rows()
+        print('Archived', ', '.join(f'{n} {t}' for t, n in moved.items()))
+        sys.exit(0)
+    if '--bench-backup' in sys.argv:
+        bench_backup()
+        sys.exit(0)
+    if '--bench-transport' in sys.argv:
+        bench_transport()
+        sys.exit(0)
+    if '--bench-shards' in sys.argv:
+        bench_shards(int(sys.argv[sys.argv.index('--bench-shards') + 1]))
+        sys.exit(0)
 
     print('Starting bot...')
     if API_ID and API_HASH and not os.path.exists(USERBOT_SESSION):
@@ -1041,4 +3057,7 @@ if __name__ == '__main__':
         print('python', sys.argv[0], '--create-session')
         print('This will prompt for phone + code in your terminal (one-time).')
 
-    executor.start_polling(dp, skip_updates=True)
+    if SHARD_WORKERS > 0:
+        run_sharded(SHARD_WORKERS)
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)